@@ -1,33 +1,73 @@
 import vrchatapi
+import asyncio
 import os
 import json
-import aiohttp
+import math
+import time
 from urllib.parse import urlencode
 
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import FastAPI, HTTPException, Header, Form, File, UploadFile
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 from contextlib import asynccontextmanager
+from pydantic import ValidationError
 
 from payloads import *
 
-from connector.sender import Sender
+from connector.breaker import ConnectorUnavailable
+from connector.router import ConnectorRouter
 from utils.logger import Logger
 from utils.database import UsersDB
-from utils.auth import AuthUtil
-from utils.vrc import VRChatLogin
+from utils.sqlite import database
+from utils.http import http_client
+from utils.admission import AdmissionController, AdmissionRejected
+from utils.series import SeriesDB, SeriesScheduler, parse_time
+from utils.jobs import JobsDB, JobQueue
+from utils.auth import AuthUtil, AccessRevoked, token_cache, ACCESS_TOKEN_TTL, REFRESH_TOKEN_TTL
+from utils.vrc import VRChatLogin, VRChatSessionManager, PENDING_LOGIN_TTL
+from utils.state import state_backend
 
 Log = Logger(__name__)
 
 DISCORD_API_BASE = "https://discord.com/api"
 
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_CONTENT_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+
+BULK_CREATE_MAX_EVENTS = int(os.environ.get("BULK_CREATE_MAX_EVENTS", 100))
+BULK_CREATE_TIMEOUT = 900
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """StreamingResponse that holds an admission slot until the response is over.
+
+    The slot is released even when the client disconnects before the body starts, in
+    which case the body generator never runs.
+    """
+
+    def __init__(self, content, admission: AdmissionController, caller: str | None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+        self.caller = caller
+        self.started_at = time.monotonic()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.release(self.caller, time.monotonic() - self.started_at)
+
 class VRCEvMngrAPI(FastAPI):
     def __init__(self):
-        self.sender = Sender(
-            ip=os.environ.get("BOT_SOCK_ADDRESS"),
-            port=int(os.environ.get("BOT_SOCK_PORT"))
-            )
+        # BOT_SOCK_ADDRESSESで複数のBotを指定した場合はguild_idごとに振り分ける
+        self.sender = ConnectorRouter.from_env()
+        self.series_scheduler = SeriesScheduler(self.sender)
+        self.job_queue = JobQueue(self.sender)
+        # Botの応答を待つエンドポイントの同時実行数を制限する
+        self.admission = AdmissionController()
+        # ログイン済みのVRChat APIクライアントをアカウントごとに使い回す
+        self.vrchat = VRChatSessionManager()
         super().__init__(
             title="VRChatEventManager-API"
         )
@@ -42,19 +82,46 @@ class VRCEvMngrAPI(FastAPI):
         
         @asynccontextmanager
         async def lifespan(app: FastAPI):
-            try:
-                await UsersDB.init_db()
-                AuthUtil.generate_key()
-                await self.sender.connect_async()
-            except OSError as e:
-                Log.warning(f"initial connection to bot failed: {e}")
+            self.sender.on_push(UsersDB.apply_push, topics=UsersDB.PUSH_TOPICS)
+            self.sender.on_push_reset(UsersDB.flush_admin_cache)
+            await database.open()
+            await http_client.start()
+            await state_backend.init()
+            await UsersDB.init_db()
+            await SeriesDB.init_schema()
+            await JobsDB.init_schema()
+            AuthUtil.generate_key()
+            # Botが起動していなくても待たずに起動し、接続はバックグラウンドで続ける
+            await self.sender.start()
+            self.series_scheduler.start()
+            self.job_queue.start()
+            self.vrchat.start()
             yield
+            await self.vrchat.stop()
+            await self.job_queue.stop()
+            await self.series_scheduler.stop()
+            await self.sender.close_async()
+            await http_client.close()
+            await database.close()
         
         self.router.lifespan_context = lifespan
-        
-        self.vrc_api_client = None
-        self.vrc_email = None
-        self.vrc_password = None
+
+        @self.exception_handler(ConnectorUnavailable)
+        async def connector_unavailable(request: Request, exc: ConnectorUnavailable):
+            return JSONResponse(
+                status_code=503,
+                content={"detail": "Bot is unavailable"},
+                headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))}
+            )
+
+        @self.exception_handler(AdmissionRejected)
+        async def admission_rejected(request: Request, exc: AdmissionRejected):
+            return JSONResponse(
+                status_code=429,
+                content={"detail": exc.reason},
+                headers={"Retry-After": str(math.ceil(exc.retry_after))}
+            )
+
 
         @self.get("/api/login")
         async def login(request: Request):
@@ -80,114 +147,359 @@ class VRCEvMngrAPI(FastAPI):
             if not code:
                 raise HTTPException(status_code=400, detail="Missing Arguments")
 
-            async with aiohttp.ClientSession() as session:
-                headers = { "Content-Type": "application/x-www-form-urlencoded" }
-                data = {
-                    "client_id": os.environ.get("CLIENT_ID"),
-                    "client_secret": os.environ.get("CLIENT_SECRET"),
-                    "grant_type": "authorization_code",
-                    "code": code,
-                    "redirect_uri": os.environ.get("REDIRECT_URL")
-                }
-                async with session.post(f"{DISCORD_API_BASE}/oauth2/token", headers=headers, data=data) as resp:
-                    if resp.status != 200:
-                        Log.error(f"Failed to fetch token from Discord: {resp.status} | {await resp.text()}")
-                        raise HTTPException(status_code=503, detail="Failed to fetch token from Discord")
-                    token_data = await resp.json()
-
-                headers = { "Authorization": f"Bearer {token_data['access_token']}" }
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(f"{DISCORD_API_BASE}/users/@me", headers=headers) as resp:
-                        user_data = await resp.json()
-                        
-            allowed = await UsersDB.is_user_allowed(int(user_data["id"]), self.sender)
+            session = http_client.session
+            headers = { "Content-Type": "application/x-www-form-urlencoded" }
+            data = {
+                "client_id": os.environ.get("CLIENT_ID"),
+                "client_secret": os.environ.get("CLIENT_SECRET"),
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": os.environ.get("REDIRECT_URL")
+            }
+            async with session.post(f"{DISCORD_API_BASE}/oauth2/token", headers=headers, data=data) as resp:
+                if resp.status != 200:
+                    Log.error(f"Failed to fetch token from Discord: {resp.status} | {await resp.text()}")
+                    raise HTTPException(status_code=503, detail="Failed to fetch token from Discord")
+                token_data = await resp.json()
+
+            headers = { "Authorization": f"Bearer {token_data['access_token']}" }
+            async with session.get(f"{DISCORD_API_BASE}/users/@me", headers=headers) as resp:
+                user_data = await resp.json()
+
+            async with self.admission.admit(str(user_data["id"])):
+                allowed = await UsersDB.is_user_allowed(int(user_data["id"]), self.sender)
             if not allowed:
                 raise HTTPException(status_code=403, detail="Access Denied")
 
-            jwt_payload = {
-                "user_id": user_data["id"],
-                "email": user_data["email"],
-            }
-            jwt_token = AuthUtil.encode(jwt_payload)
+            access_token = AuthUtil.issue_access_token(user_data["id"], user_data["email"])
+            refresh_token = await AuthUtil.issue_refresh_token(user_data["id"], user_data["email"])
             response = RedirectResponse(url="https://" + os.environ.get("DOMAIN").rstrip("/") + "/dash")
-            response.set_cookie(
-                key="Authorization",
-                value=jwt_token,
-                httponly=True,
-                secure=True,
-                samesite="lax",
-                domain="." + os.environ.get("DOMAIN")
-            )
+            self.set_auth_cookies(response, access_token, refresh_token)
    
             Log.debug(f"User {user_data['id']} logged in successfully")
             return response
 
+        @self.post("/api/login/refresh")
+        async def refresh(request: Request):
+            refresh_token = request.cookies.get("Refresh", None)
+            if not refresh_token:
+                raise HTTPException(status_code=401, detail="Missing Refresh Token")
+
+            try:
+                tokens = await AuthUtil.refresh(refresh_token, self.sender, self.admission)
+            except AccessRevoked:
+                response = JSONResponse(status_code=401, content={"detail": "Access Denied"})
+                self.clear_auth_cookies(response)
+                return response
+
+            if tokens is None:
+                # 同時に更新した別のタブが既に新しいCookieを受け取っている場合があるため、ここでは消さない
+                raise HTTPException(status_code=401, detail="Invalid or Expired Refresh Token")
+
+            access_token, refresh_token = tokens
+            response = JSONResponse(content={"expires_in": ACCESS_TOKEN_TTL})
+            self.set_auth_cookies(response, access_token, refresh_token)
+            return response
+
+        @self.post("/api/login/logout")
+        async def logout(request: Request):
+            refresh_token = request.cookies.get("Refresh", None)
+            if refresh_token:
+                await UsersDB.pop_refresh_token(AuthUtil.hash_refresh_token(refresh_token))
+
+            response = JSONResponse(content={"logout": True})
+            self.clear_auth_cookies(response)
+            return response
+
         @self.post("/api/dsc/create_announcement")
         async def send_announcement(payload: AnnouncementPayload, Authorization: str = Header()):
             if not await AuthUtil.verify_user(Authorization, self.sender):
                 raise HTTPException(status_code=403, detail="Invalid or Expired Token")
             
+            return await enqueue_job("send_announcement", {
+                "guild_id": payload.guild_id,
+                "channel_id": payload.channel_id,
+                "everyone": payload.everyone,
+                "message": payload.message
+            }, payload.run_at, AuthUtil.caller(Authorization))
+
+        @self.post("/api/dsc/create_event")
+        async def create_event(payload: CreateEventPayload, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            if payload.recurrence is not None:
+                return await create_series(payload, AuthUtil.caller(Authorization))
+            
+            return await enqueue_job("create_event", {
+                "guild_id": payload.guild_id,
+                "channel_id": payload.channel_id,
+                "name": payload.name,
+                "description": payload.description,
+                "start_time": payload.start_time,
+                "end_time": payload.end_time,
+                "entity_type": payload.entity_type,
+                "location": payload.location,
+                "image_uri": payload.image_uri
+            }, payload.run_at, AuthUtil.caller(Authorization))
+
+        async def enqueue_job(action: str, message: dict, run_at: str | None, caller: str | None):
+            # Botへは送らずにキューへ登録してすぐに返す (実行はJobQueueのワーカーが行う)
             try:
-                message_payload = json.dumps({
-                    "action": "send_announcement",
-                    "channel_id": payload.channel_id,
-                    "everyone": payload.everyone,
-                    "message": payload.message
-                })
-                response = await self.sender.send_async(message_payload)
-                
+                run_at_ts = None if run_at is None else parse_time(run_at, "run_at").timestamp()
+            except ValueError as exc:
+                raise HTTPException(status_code=422, detail=str(exc)) from exc
+
+            try:
+                job_id = await self.job_queue.enqueue(action, {**message, "caller": caller}, run_at_ts)
             except Exception as exc:
-                Log.error(f"Failed to send_announcement: {exc}")
-                raise HTTPException(status_code=500, detail="Failed to send announcement") from exc
+                Log.error(f"Failed to enqueue {action}: {exc}")
+                raise HTTPException(status_code=500, detail="Failed to enqueue job") from exc
+
+            return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+        @self.get("/api/jobs/{job_id}")
+        async def get_job(job_id: int, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            job = await JobsDB.get_job(job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail="Job not found")
+            return JSONResponse(content=job)
+
+        async def create_series(payload: CreateEventPayload, caller: str | None):
+            if payload.start_time is None:
+                raise HTTPException(status_code=422, detail="start_time is required for a recurring event")
+
+            try:
+                series_id = await SeriesDB.create_series(
+                    guild_id=payload.guild_id,
+                    template=payload.model_dump(exclude={"start_time", "end_time", "recurrence", "run_at"}),
+                    rule=payload.recurrence.rrule,
+                    start_time=payload.start_time,
+                    end_time=payload.end_time,
+                    count=payload.recurrence.count,
+                    until=payload.recurrence.until
+                )
+            except ValueError as exc:
+                raise HTTPException(status_code=422, detail=str(exc)) from exc
+
+            # 最初の数回はすぐに作成する。Botに届かない場合はスケジューラが後で作成する
+            try:
+                async with self.admission.admit(caller):
+                    created = await self.series_scheduler.extend(await SeriesDB.get_series(series_id))
+            except (ConnectionError, OSError, asyncio.TimeoutError, AdmissionRejected) as exc:
+                Log.warning(f"Deferred creation of series {series_id}: {exc}")
+                created = 0
+
+            return JSONResponse(content={
+                "status": "ok",
+                "message": {"series_id": series_id, "created": created}
+            })
+
+        @self.get("/api/dsc/series")
+        async def list_series(Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            return JSONResponse(content={"series": await SeriesDB.get_series_list()})
+
+        @self.post("/api/dsc/series/{series_id}/cancel")
+        async def cancel_series(series_id: int, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            # 作成済みのイベントはそのまま残し、以降の回を作成しない
+            if not await SeriesDB.finish_series(series_id):
+                raise HTTPException(status_code=404, detail="Series not found")
+            return JSONResponse(content={"cancelled": series_id})
+
+        @self.post("/api/dsc/create_events")
+        async def create_events(payload: CreateEventsPayload, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            if not payload.events:
+                raise HTTPException(status_code=422, detail="No events given")
+            if len(payload.events) > BULK_CREATE_MAX_EVENTS:
+                raise HTTPException(status_code=413, detail=f"Too many events (max {BULK_CREATE_MAX_EVENTS})")
+            if any(event.recurrence is not None for event in payload.events):
+                raise HTTPException(status_code=422, detail="Recurring events must be created one at a time")
+
+            caller = AuthUtil.caller(Authorization)
+            message_payload = {
+                "action": "create_events",
+                "caller": caller,
+                # 振り分け先を決めるため。異なるサーバーのイベントが含まれていてもBotはREST経由で作成できる
+                "guild_id": payload.events[0].guild_id,
+                "events": [event.model_dump(exclude={"recurrence", "run_at"}) for event in payload.events]
+            }
+
+            if payload.stream:
+                async def results():
+                    # 1行に1件ずつ、作成が終わった順に返す (NDJSON)。最後の行は集計結果
+                    try:
+                        async for response in self.sender.stream_async(message_payload, timeout=BULK_CREATE_TIMEOUT):
+                            yield json.dumps(response) + "\n"
+                    except Exception as exc:
+                        Log.error(f"Failed to create events: {exc}")
+                        yield json.dumps({"status": "error", "message": "Failed to create events"}) + "\n"
+
+                # 応答を返し始めた後では503や429にできないため、先に確認する。枠は応答が終わった時点で返す
+                self.sender.ensure_available(message_payload["guild_id"])
+                await self.admission.acquire(caller)
+                return AdmittedStreamingResponse(results(), self.admission, caller, media_type="application/x-ndjson")
+
+            async with self.admission.admit(caller):
+                try:
+                    response = await self.sender.send_async(message_payload, timeout=BULK_CREATE_TIMEOUT)
+
+                except ConnectorUnavailable:
+                    raise
+                except Exception as exc:
+                    Log.error(f"Failed to create events: {exc}")
+                    raise HTTPException(status_code=500, detail="Failed to create events") from exc
 
             return JSONResponse(content=response)
 
-        @self.post("/api/dsc/create_event")
-        async def create_event(payload: CreateEventPayload, Authorization: str = Header()):
+        @self.get("/api/users/allowed")
+        async def export_allowed_users(Authorization: str = Header()):
             if not await AuthUtil.verify_user(Authorization, self.sender):
                 raise HTTPException(status_code=403, detail="Invalid or Expired Token")
-            
+
+            return JSONResponse(content={"users": await UsersDB.get_allowed_users()})
+
+        @self.post("/api/users/allowed/import")
+        async def import_allowed_users(payload: AllowedUsersImportPayload, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
             try:
-                message_payload = json.dumps({
+                imported = await UsersDB.import_allowed_users(
+                    [(user.user_id, user.email) for user in payload.users],
+                    replace=payload.replace
+                )
+            except Exception as exc:
+                Log.error(f"Failed to import allowed users: {exc}")
+                raise HTTPException(status_code=500, detail="Failed to import allowed users") from exc
+
+            return JSONResponse(content={"imported": imported})
+
+        @self.post("/api/users/allowed/remove")
+        async def remove_allowed_users(payload: AllowedUsersRemovePayload, Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            try:
+                removed = await UsersDB.remove_allowed_users(payload.user_ids)
+            except Exception as exc:
+                Log.error(f"Failed to remove allowed users: {exc}")
+                raise HTTPException(status_code=500, detail="Failed to remove allowed users") from exc
+
+            return JSONResponse(content={"removed": removed})
+
+        @self.get("/api/metrics")
+        async def metrics(Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            try:
+                async with self.admission.admit(AuthUtil.caller(Authorization)):
+                    bot_stats = await self.sender.broadcast_async({"action": "stats"})
+            except Exception as exc:
+                Log.error(f"Failed to fetch bot stats: {exc}")
+                bot_stats = {}
+
+            return JSONResponse(content={
+                "admin_cache": UsersDB.admin_cache.stats(),
+                "jwt_cache": token_cache.stats(),
+                "http": http_client.stats(),
+                "connector": self.sender.stats(),
+                "admission": self.admission.stats(),
+                "vrchat": self.vrchat.stats(),
+                "jobs": await JobsDB.counts(),
+                "push_topics": sorted(self.sender.push_topics),
+                "bot": {address: stats.get("message") if stats else None for address, stats in bot_stats.items()}
+            })
+
+        @self.post("/api/dsc/create_event/upload")
+        async def create_event_upload(payload: str = Form(), image: UploadFile = File(), Authorization: str = Header()):
+            if not await AuthUtil.verify_user(Authorization, self.sender):
+                raise HTTPException(status_code=403, detail="Invalid or Expired Token")
+
+            try:
+                event = CreateEventPayload.model_validate_json(payload)
+            except ValidationError as exc:
+                raise HTTPException(status_code=422, detail=exc.errors(include_url=False)) from exc
+            if event.recurrence is not None:
+                raise HTTPException(status_code=422, detail="Recurring events cannot use an uploaded image")
+
+            if image.content_type not in UPLOAD_CONTENT_TYPES:
+                raise HTTPException(status_code=415, detail="Unsupported image type")
+            if image.size is not None and image.size > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Image too large")
+
+            async def chunks():
+                # 固定サイズで読み出してそのままBotへ流す (全体をメモリに載せない)
+                total = 0
+                while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+                    total += len(chunk)
+                    if total > UPLOAD_MAX_BYTES:
+                        raise HTTPException(status_code=413, detail="Image too large")
+                    yield chunk
+
+            caller = AuthUtil.caller(Authorization)
+            try:
+                message_payload = {
                     "action": "create_event",
-                    "guild_id": payload.guild_id,
-                    "channel_id": payload.channel_id,
-                    "name": payload.name,
-                    "description": payload.description,
-                    "start_time": payload.start_time,
-                    "end_time": payload.end_time,
-                    "entity_type": payload.entity_type,
-                    "location": payload.location,
-                    "image_uri": payload.image_uri
-                })
-                response = await self.sender.send_async(message_payload)
+                    "caller": caller,
+                    **event.model_dump(exclude={"image_uri", "recurrence", "run_at"})
+                }
+                async with self.admission.admit(caller):
+                    response = await self.sender.send_async(message_payload, attachment=chunks())
 
+            except (HTTPException, ConnectorUnavailable, AdmissionRejected):
+                raise
             except Exception as exc:
                 Log.error(f"Failed to create event: {exc}")
                 raise HTTPException(status_code=500, detail="Failed to create event") from exc
 
+            finally:
+                await image.close()
+
             return JSONResponse(content=response)
-        
+
         @self.post("/api/vrc/login")
         async def vrc_login(request: Request, payload: VRCLoginPayload, Authorization: str = Header()):
             if not await AuthUtil.verify_user(Authorization, self.sender):
                 raise HTTPException(status_code=403, detail="Invalid or Expired Token")
 
+            # 2FAのリクエストは別のワーカーが受け付けることもあるため、続きに必要な情報は共有の状態に置く
+            pending_key = f"vrc_pending:{AuthUtil.caller(Authorization)}"
             vrchat_login = VRChatLogin(payload.email, payload.password)
             try:
+                # 既に同じアカウントでログイン済みなら、保持しているセッションで確認して2FAを求めずに返す
+                current_user = await self.vrchat.logged_in_user(payload.email, payload.password)
+                if current_user is not None:
+                    await state_backend.delete(pending_key)
+                    return JSONResponse(content={
+                        "user_id": current_user.id,
+                        "display_name": current_user.display_name
+                    })
+
                 api_client, current_user = await vrchat_login.login_async()
                 
-                self.vrc_api_client = api_client
-                self.vrc_email = payload.email
-                self.vrc_password = payload.password
-                
                 if not isinstance(current_user, vrchatapi.CurrentUser):
+                    await state_backend.set(pending_key, vrchat_login.pending(api_client), ttl=PENDING_LOGIN_TTL)
                     return JSONResponse(content={
                         "twofa_required": True,
                         "twofa_type": current_user  # "Email" or "TOTP"
                     })
                 
                 else:
+                    await state_backend.delete(pending_key)
+                    self.vrchat.adopt(payload.email, api_client)
                     return JSONResponse(content={
                         "user_id": current_user.id,
                         "display_name": current_user.display_name
@@ -195,9 +507,7 @@ class VRCEvMngrAPI(FastAPI):
                     
             except Exception as e:
                 Log.error(f"VRChat login failed: {e}")
-                self.vrc_api_client = None
-                self.vrc_email = None
-                self.vrc_password = None
+                await state_backend.delete(pending_key)
                 raise HTTPException(status_code=500, detail="VRChat login failed")
         
         @self.post("/api/vrc/twofa")
@@ -205,13 +515,17 @@ class VRCEvMngrAPI(FastAPI):
             if not await AuthUtil.verify_user(Authorization, self.sender):
                 raise HTTPException(status_code=403, detail="Invalid or Expired Token")
             
-            if not self.vrc_email or not self.vrc_password:
+            # 取り出した時点で消え、コードの入力は1回だけ受け付ける
+            pending = await state_backend.pop(f"vrc_pending:{AuthUtil.caller(Authorization)}")
+            resumed = VRChatLogin.from_pending(pending) if pending else None
+            if resumed is None:
                 raise HTTPException(status_code=400, detail="VRChat credentials not found. Please login again.")
 
-            vrchat_login = VRChatLogin(self.vrc_email, self.vrc_password)
+            vrchat_login, pending_client = resumed
+            adopted = False
             try:
                 api_client, current_user = await vrchat_login.twofa_async(
-                    api_client=self.vrc_api_client,
+                    api_client=pending_client,
                     code=payload.code,
                     type=payload.type
                 )
@@ -220,6 +534,9 @@ class VRCEvMngrAPI(FastAPI):
                     raise HTTPException(status_code=500, detail="2FA verification failed")
                 
                 else:
+                    # 認証済みのクライアントは閉じずに以降のVRChat APIの呼び出しに使う
+                    self.vrchat.adopt(vrchat_login.email, api_client)
+                    adopted = True
                     return JSONResponse(content={
                         "user_id": current_user.id,
                         "display_name": current_user.display_name
@@ -230,24 +547,22 @@ class VRCEvMngrAPI(FastAPI):
                 raise HTTPException(status_code=500, detail="VRChat 2FA verification failed")
             
             finally:
-                self.vrc_api_client = None
-                self.vrc_email = None
-                self.vrc_password = None
+                if not adopted:
+                    pending_client.close()
         
         @self.post("/api/vrc/logout")
         async def vrc_logout(request: Request, Authorization: str = Header()):
             if not await AuthUtil.verify_user(Authorization, self.sender):
                 raise HTTPException(status_code=403, detail="Invalid or Expired Token")
             
-            vrchat_login = VRChatLogin(self.vrc_email, self.vrc_password)
+            vrchat_login = VRChatLogin(None, None)
             try:
                 removed = await vrchat_login.logout_async()
                 if not removed:
                     raise HTTPException(status_code=500, detail="VRChat logout failed")
                 
-                self.vrc_api_client = None
-                self.vrc_email = None
-                self.vrc_password = None
+                await state_backend.delete(f"vrc_pending:{AuthUtil.caller(Authorization)}")
+                self.vrchat.invalidate()
                 
                 return JSONResponse(content={
                     "logout": True
@@ -255,4 +570,33 @@ class VRCEvMngrAPI(FastAPI):
                 
             except Exception as e:
                 Log.error(f"VRChat logout failed: {e}")
-                raise HTTPException(status_code=500, detail="VRChat logout failed")
\ No newline at end of file
+                raise HTTPException(status_code=500, detail="VRChat logout failed")
+
+    @staticmethod
+    def set_auth_cookies(response, access_token: str, refresh_token: str):
+        domain = "." + os.environ.get("DOMAIN")
+        response.set_cookie(
+            key="Authorization",
+            value=access_token,
+            max_age=ACCESS_TOKEN_TTL,
+            httponly=True,
+            secure=True,
+            samesite="lax",
+            domain=domain
+        )
+        response.set_cookie(
+            key="Refresh",
+            value=refresh_token,
+            max_age=REFRESH_TOKEN_TTL,
+            path="/api/login",
+            httponly=True,
+            secure=True,
+            samesite="strict",
+            domain=domain
+        )
+
+    @staticmethod
+    def clear_auth_cookies(response):
+        domain = "." + os.environ.get("DOMAIN")
+        response.delete_cookie(key="Authorization", domain=domain)
+        response.delete_cookie(key="Refresh", path="/api/login", domain=domain)
@@ -0,0 +1,80 @@
+import enum
+import time
+
+
+class ConnectorUnavailable(ConnectionError):
+    """The bot cannot be reached right now; the request was not sent."""
+
+    def __init__(self, message: str = "bot connector unavailable", retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class State(str, enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Circuit breaker for the bot connection.
+
+    CLOSED lets requests through. OPEN rejects them. HALF_OPEN is used while a health
+    probe is in flight and also rejects them. Losing the connection opens the circuit at
+    once. Timeouts open it only after ``failure_threshold`` of them in a row.
+    """
+
+    def __init__(self, failure_threshold: int):
+        self.failure_threshold = failure_threshold
+        self.state = State.CLOSED
+        self.failures = 0
+        self.opened_at: float | None = None
+        # 次の再接続を試みる時刻 (Retry-Afterに使う)
+        self.retry_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == State.CLOSED:
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self) -> bool:
+        """失敗を記録し、これで回路が開いた場合にTrueを返す。"""
+        self.failures += 1
+        if self.state == State.CLOSED and self.failures >= self.failure_threshold:
+            self.trip()
+            return True
+        return False
+
+    def trip(self):
+        if self.state == State.CLOSED:
+            self.trips += 1
+            self.opened_at = time.monotonic()
+        self.state = State.OPEN
+
+    def half_open(self):
+        self.state = State.HALF_OPEN
+
+    def reset(self):
+        self.state = State.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.retry_at = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state.value,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "open_for": round(time.monotonic() - self.opened_at, 3) if self.opened_at is not None else None,
+            "retry_after": round(self.retry_after(), 3) if self.state != State.CLOSED else None,
+        }
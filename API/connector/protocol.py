@@ -0,0 +1,148 @@
+"""API <-> Bot connector wire format.
+
+Every message is a frame: a fixed-size header followed by ``length`` payload bytes.
+
+    version (u8) | kind (u8) | flags (u16) | stream_id (u32) | length (u32)
+
+``stream_id`` carries the request ID (0 is reserved for connection-level frames).
+A request may be followed by BLOB frames with the same ID carrying a binary attachment.
+A streamed request is answered with any number of PARTIAL responses before the final one.
+The same module lives in API/connector and Bot/connector; keep both copies identical.
+"""
+import asyncio
+import json
+import os
+import struct
+from typing import NamedTuple, Optional
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBHII")
+MAX_FRAME_SIZE = int(os.environ.get("CONNECTOR_MAX_FRAME_SIZE", 16 * 1024 * 1024))
+READ_CHUNK = 64 * 1024
+
+
+class Kind:
+    HELLO = 0
+    REQUEST = 1
+    RESPONSE = 2
+    PUSH = 3  # Bot -> API の一方向通知 (stream_id は常に0)
+    BLOB = 4  # REQUESTに続くバイナリデータ (stream_id はリクエストID)
+
+
+class Flags:
+    END = 0x1     # BLOBの最後のフレーム
+    ABORT = 0x2   # 送信側が途中で送信を中止した
+    PARTIAL = 0x4 # 最終ではないRESPONSE (後に同じIDのRESPONSEが続く)
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+class FrameTooLarge(ProtocolError):
+    pass
+
+
+class Frame(NamedTuple):
+    kind: int
+    flags: int
+    stream_id: int
+    payload: memoryview
+
+    def json(self):
+        return json.loads(str(self.payload, "utf-8"))
+
+
+def hello(role: str, **extra) -> dict:
+    """HELLOフレームの内容。``extra`` は相手側が参照する任意の情報 (Botの担当シャードなど)。"""
+    return {**extra, "version": PROTOCOL_VERSION, "role": role, "max_frame_size": MAX_FRAME_SIZE}
+
+
+def check_hello(frame: Optional[Frame]) -> dict:
+    if frame is None:
+        raise ProtocolError("connection closed during handshake")
+    if frame.kind != Kind.HELLO:
+        raise ProtocolError(f"expected HELLO, got frame kind {frame.kind}")
+    data = frame.json()
+    if data.get("version") != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {data.get('version')}")
+    return data
+
+
+def write_frame(writer: asyncio.StreamWriter, kind: int, payload: bytes, stream_id: int = 0,
+                flags: int = 0, max_frame_size: int = MAX_FRAME_SIZE):
+    if len(payload) > max_frame_size:
+        raise FrameTooLarge(f"frame of {len(payload)} bytes exceeds limit of {max_frame_size}")
+    # ヘッダとペイロードを連結せずにそのまま書き込む
+    writer.writelines((HEADER.pack(PROTOCOL_VERSION, kind, flags, stream_id, len(payload)), payload))
+
+
+def write_json(writer: asyncio.StreamWriter, kind: int, obj, stream_id: int = 0,
+               flags: int = 0, max_frame_size: int = MAX_FRAME_SIZE):
+    payload = json.dumps(obj, separators=(",", ":")).encode("utf-8")
+    write_frame(writer, kind, payload, stream_id, flags, max_frame_size)
+
+
+class FrameReader:
+    """Reassembles frames from a StreamReader into one reusable buffer.
+
+    The payload of a returned frame is a view into that buffer and is only valid
+    until the next call to ``read_frame``.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, max_frame_size: int = MAX_FRAME_SIZE):
+        self._reader = reader
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._start = 0
+        self._view: Optional[memoryview] = None
+
+    async def read_frame(self) -> Optional[Frame]:
+        """Returns the next frame, or None once the peer closed the connection cleanly."""
+        self._release()
+        while True:
+            frame = self._parse()
+            if frame is not None:
+                return frame
+
+            chunk = await self._reader.read(READ_CHUNK)
+            if not chunk:
+                if len(self._buffer) > self._start:
+                    raise ProtocolError("connection closed in the middle of a frame")
+                return None
+            self._compact()
+            self._buffer += chunk
+
+    def _parse(self) -> Optional[Frame]:
+        offset = self._start
+        if len(self._buffer) - offset < HEADER.size:
+            return None
+
+        version, kind, flags, stream_id, length = HEADER.unpack_from(self._buffer, offset)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"unsupported protocol version {version}")
+        if length > self.max_frame_size:
+            raise FrameTooLarge(f"frame of {length} bytes exceeds limit of {self.max_frame_size}")
+
+        end = offset + HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+
+        self._view = memoryview(self._buffer)[offset + HEADER.size:end]
+        self._start = end
+        return Frame(kind, flags, stream_id, self._view)
+
+    def _release(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+    def _compact(self):
+        if not self._start:
+            return
+        try:
+            del self._buffer[:self._start]
+        except BufferError:
+            # 呼び出し側がペイロードの派生ビューを保持している場合は新しいバッファに移す
+            self._buffer = bytearray(self._buffer[self._start:])
+        self._start = 0
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+from connector.breaker import ConnectorUnavailable
+from connector.sender import Sender
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+
+def shard_of(guild_id: int, shard_count: int) -> int:
+    """Discordがサーバーを割り当てるシャード番号。"""
+    return (guild_id >> 22) % shard_count
+
+
+def parse_addresses(value: str) -> list[tuple[str, int]]:
+    """``host:port,host:port`` 形式のBotのアドレス一覧を読む。"""
+    addresses = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError(f"invalid bot address: {entry!r} (expected host:port)")
+        addresses.append((host, int(port)))
+    return addresses
+
+
+class ConnectorRouter:
+    """Routes connector calls to one of several bot instances by guild.
+
+    A bot that reports the guild's shard in its HELLO owns the guild. The rest follow in
+    rendezvous-hash order, so every API process agrees on the order and a guild only
+    moves when one of its candidates goes down. Any healthy bot can serve any guild over
+    REST, so failover only costs gateway cache locality.
+    """
+
+    def __init__(self, senders: list[Sender], default_guild_id: int = 0):
+        if not senders:
+            raise ValueError("at least one bot address is required")
+        self.senders = senders
+        # guild_idを含まないリクエスト (ping, statsなど) の振り分けに使う
+        self.default_guild_id = default_guild_id
+        self.routed: dict[str, int] = {sender.address: 0 for sender in senders}
+        self.failovers = 0
+
+    @classmethod
+    def from_env(cls) -> "ConnectorRouter":
+        addresses = os.environ.get("BOT_SOCK_ADDRESSES")
+        if addresses:
+            targets = parse_addresses(addresses)
+        else:
+            targets = [(os.environ.get("BOT_SOCK_ADDRESS"), int(os.environ.get("BOT_SOCK_PORT")))]
+        return cls(
+            [Sender(ip=host, port=port) for host, port in targets],
+            default_guild_id=int(os.environ.get("GUILD_ID", 0))
+        )
+
+    @staticmethod
+    def _score(sender: Sender, guild_id: int) -> int:
+        digest = hashlib.blake2b(f"{sender.address}/{guild_id}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+
+    @staticmethod
+    def _owns(sender: Sender, guild_id: int) -> bool:
+        shard_ids = sender.peer.get("shard_ids")
+        shard_count = sender.peer.get("shard_count")
+        if not shard_ids or not shard_count:
+            return False
+        return shard_of(guild_id, shard_count) in shard_ids
+
+    def candidates(self, guild_id: Optional[int]) -> list[Sender]:
+        """guild_idを担当するBotから順に並べた接続先の一覧。"""
+        guild_id = int(guild_id or self.default_guild_id)
+        return sorted(
+            self.senders,
+            key=lambda sender: (self._owns(sender, guild_id), self._score(sender, guild_id)),
+            reverse=True
+        )
+
+    def route(self, guild_id: Optional[int], failover: bool = True) -> Sender:
+        """リクエストを送れる接続先を選ぶ。どれも送れない場合はConnectorUnavailableを送出する。
+
+        failoverがFalseの場合は担当のBotだけを使う。
+        """
+        candidates = self.candidates(guild_id)
+        if not failover:
+            candidates = candidates[:1]
+        for index, sender in enumerate(candidates):
+            if sender.available:
+                if index:
+                    self.failovers += 1
+                    Log.debug(f"guild {guild_id}: {candidates[0].address} unavailable, using {sender.address}")
+                self.routed[sender.address] += 1
+                return sender
+        # 回路が開いたままの接続の再接続を促しつつ、即座に失敗させる
+        for sender in candidates:
+            try:
+                sender.ensure_available()
+            except ConnectorUnavailable:
+                pass
+        raise ConnectorUnavailable(retry_after=min(sender.retry_after() for sender in candidates))
+
+    @staticmethod
+    def _guild_of(data: dict) -> Optional[int]:
+        guild_id = data.get("guild_id")
+        return int(guild_id) if guild_id else None
+
+    def _route_request(self, data: dict) -> Sender:
+        # idempotency_keyは受け付けたBotにしか記録されないため、再送を別のBotに回さない
+        return self.route(self._guild_of(data), failover=not data.get("idempotency_key"))
+
+    async def start(self):
+        await asyncio.gather(*(sender.start() for sender in self.senders))
+
+    async def close_async(self):
+        await asyncio.gather(*(sender.close_async() for sender in self.senders))
+
+    @property
+    def connected(self) -> bool:
+        return any(sender.connected for sender in self.senders)
+
+    @property
+    def available(self) -> bool:
+        return any(sender.available for sender in self.senders)
+
+    @property
+    def push_topics(self) -> set[str]:
+        """全てのBotから受け取れているトピック。"""
+        return set.intersection(*(sender.push_topics for sender in self.senders))
+
+    def retry_after(self) -> float:
+        return min(sender.retry_after() for sender in self.senders)
+
+    def ensure_available(self, guild_id: Optional[int] = None):
+        self.route(guild_id)
+
+    def on_push(self, handler: Callable[[dict], None], topics: Iterable[str] = ()):
+        topics = tuple(topics)
+        for sender in self.senders:
+            sender.on_push(handler, topics)
+
+    def on_push_reset(self, handler: Callable[[], None]):
+        for sender in self.senders:
+            sender.on_push_reset(handler)
+
+    def is_subscribed(self, *topics: str) -> bool:
+        # どのBotが処理したかに関わらず、通知はサーバーを担当するBotから届くため全てを確認する
+        return all(sender.is_subscribed(*topics) for sender in self.senders)
+
+    async def send_async(self, message: str | dict, attachment: Optional[AsyncIterator[bytes]] = None,
+                         timeout: Optional[float] = None) -> dict:
+        data = json.loads(message) if isinstance(message, str) else message
+        sender = self._route_request(data)
+        return await sender.send_async(data, attachment, timeout)
+
+    async def stream_async(self, message: str | dict, timeout: Optional[float] = None) -> AsyncIterator[dict]:
+        data = json.loads(message) if isinstance(message, str) else message
+        sender = self._route_request(data)
+        async for response in sender.stream_async(data, timeout):
+            yield response
+
+    async def broadcast_async(self, message: str | dict, timeout: Optional[float] = None) -> dict[str, dict | None]:
+        """全てのBotに同じリクエストを送る。応答がなかったBotはNoneになる。"""
+        data = json.loads(message) if isinstance(message, str) else message
+
+        async def send(sender: Sender) -> dict | None:
+            try:
+                return await sender.send_async(data, timeout=timeout)
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                Log.warning(f"bot at {sender.address} did not answer {data.get('action')}: {e}")
+                return None
+
+        results = await asyncio.gather(*(send(sender) for sender in self.senders))
+        return {sender.address: result for sender, result in zip(self.senders, results)}
+
+    def stats(self) -> dict:
+        return {
+            "bots": [{**sender.stats(), "routed": self.routed[sender.address]} for sender in self.senders],
+            "failovers": self.failovers,
+        }
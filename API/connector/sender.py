@@ -1,83 +1,485 @@
 import asyncio
-import socket
-import time
 import json
-from typing import Optional
+import os
+import random
+import time
+from typing import AsyncIterator, Callable, Iterable, Optional, Union
 
+from connector.breaker import CircuitBreaker, ConnectorUnavailable, State
+from connector.protocol import (
+    Kind, Flags, FrameReader, FrameTooLarge, ProtocolError, check_hello, hello, write_frame, write_json,
+    MAX_FRAME_SIZE
+)
 from utils.logger import Logger
+from utils.singleflight import SingleFlight
 
 Log = Logger(__name__)
 
+HANDSHAKE_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 5.0
+# Botとの接続が失われた後の再接続間隔 (指数バックオフ) と、復帰を確かめるpingの待ち時間
+CONNECTOR_RECONNECT_BASE = float(os.environ.get("CONNECTOR_RECONNECT_BASE", 0.5))
+CONNECTOR_RECONNECT_MAX = float(os.environ.get("CONNECTOR_RECONNECT_MAX", 30))
+CONNECTOR_PROBE_TIMEOUT = float(os.environ.get("CONNECTOR_PROBE_TIMEOUT", 5))
+# 連続してこの回数タイムアウトした場合もBotが応答していないとみなす
+CONNECTOR_FAILURE_THRESHOLD = int(os.environ.get("CONNECTOR_FAILURE_THRESHOLD", 5))
+# 副作用がなく、同じ内容なら同じ結果になるアクション。同時に送られた同一のリクエストは1回にまとめる
+COALESCED_ACTIONS = frozenset({"ping", "stats", "check_admin"})
+
+def reconnect_backoff(attempt: int) -> float:
+    delay = min(CONNECTOR_RECONNECT_MAX, CONNECTOR_RECONNECT_BASE * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 class Sender:
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, timeout: float = 30.0):
         self.ip = ip
         self.port = port
-        self.s: Optional[socket.socket] = None
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: dict[int, asyncio.Future] = {}
+        # ストリーミング応答のキュー: (response, final) または切断時の例外が入る
+        self._streams: dict[int, asyncio.Queue] = {}
+        self._last_id = 0
+        self.peer_max_frame_size = MAX_FRAME_SIZE
+        # 接続先BotのHELLOの内容 (担当シャードなど)
+        self.peer: dict = {}
+        self._push_handlers: list[Callable[[dict], None]] = []
+        self._reset_handlers: list[Callable[[], None]] = []
+        self._topics: set[str] = set()
+        # Botが購読を受け付けたトピック (接続していない間は空)
+        self.push_topics: set[str] = set()
+        self._push_seq = 0
+        self._subscribe_task: Optional[asyncio.Task] = None
+        self.inflight = SingleFlight()
+        self.breaker = CircuitBreaker(CONNECTOR_FAILURE_THRESHOLD)
+        self._recover_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self._connect_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    @property
+    def available(self) -> bool:
+        """今リクエストを送れるか (接続済みで回路が閉じている)。"""
+        return self.connected and self.breaker.state == State.CLOSED
+
+    async def connect_async(self, retries: int = 5, delay: float = 5.0):
+        async with self._connect_lock:
+            if self.connected:
+                return
+
+            last_exc: Optional[Exception] = None
+            for attempt in range(1, retries + 1):
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.ip, self.port), CONNECT_TIMEOUT
+                    )
+                    frames = await self._handshake(reader, writer)
+                except (OSError, asyncio.TimeoutError) as e:
+                    last_exc = e
+                    Log.warning(f"connection attempt {attempt}/{retries} failed: {e!r}")
+                    if attempt < retries:
+                        await asyncio.sleep(delay)
+                    continue
+
+                self.reader = reader
+                self.writer = writer
+                self._loop = asyncio.get_running_loop()
+                self._reader_task = asyncio.create_task(self._read_loop(reader, frames))
+                Log.info(f"connected to {self.ip}:{self.port}")
+                return
+
+            Log.error(f"failed to connect to {self.ip}:{self.port} after {retries} attempts")
+            if last_exc is not None:
+                raise last_exc
+            raise OSError(f"Could not connect to {self.ip}:{self.port}")
+
+    async def start(self):
+        """Botへ接続する。接続できない場合は回路を開き、バックグラウンドで再接続を続ける。"""
+        self._closed = False
+        if not await self._probe():
+            self._start_recovery()
+
+    @property
+    def address(self) -> str:
+        return f"{self.ip}:{self.port}"
+
+    def retry_after(self) -> float:
+        return self.breaker.retry_after() if not self.available else 0.0
+
+    def ensure_available(self):
+        """リクエストを送れない状態なら、待たずにConnectorUnavailableを送出する。"""
+        if not self.breaker.allow():
+            raise ConnectorUnavailable(retry_after=self.breaker.retry_after())
+        if not self.connected:
+            # 回路が閉じたまま接続がない (起動前・終了後)
+            self.breaker.trip()
+            self._start_recovery()
+            raise ConnectorUnavailable(retry_after=self.breaker.retry_after())
+
+    def _start_recovery(self):
+        if self._closed or (self._recover_task is not None and not self._recover_task.done()):
+            return
+        self._recover_task = asyncio.get_running_loop().create_task(self._recover())
+
+    async def _recover(self):
+        attempt = 0
+        while not self._closed:
+            attempt += 1
+            delay = reconnect_backoff(attempt)
+            self.breaker.retry_at = time.monotonic() + delay
+            await asyncio.sleep(delay)
+            if await self._probe():
+                return
 
-    def connect(self, retries: int = 5, delay: float = 5.0):
-        if self.s is not None:
+    async def _probe(self) -> bool:
+        """接続してpingを送り、応答があれば回路を閉じる。"""
+        try:
+            if not self.connected:
+                await self.connect_async(retries=1)
+            self.breaker.half_open()
+            response = await self._request({"action": "ping"}, None, CONNECTOR_PROBE_TIMEOUT, probe=True)
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            Log.warning(f"bot health probe failed: {e!r}")
+            self.breaker.trip()
+            return False
+        if response.get("status") != "ok":
+            Log.warning(f"bot health probe rejected: {response.get('message')}")
+            self.breaker.trip()
+            return False
+
+        self.breaker.reset()
+        Log.info(f"bot at {self.address} is available")
+        if self._topics:
+            self._subscribe_task = asyncio.create_task(self._subscribe())
+        return True
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> FrameReader:
+        frames = FrameReader(reader)
+        try:
+            write_json(writer, Kind.HELLO, hello("api"))
+            await writer.drain()
+            peer = check_hello(await asyncio.wait_for(frames.read_frame(), HANDSHAKE_TIMEOUT))
+        except asyncio.TimeoutError:
+            writer.close()
+            raise ProtocolError("handshake timed out")
+        except BaseException:
+            writer.close()
+            raise
+        self.peer_max_frame_size = int(peer.get("max_frame_size", MAX_FRAME_SIZE))
+        self.peer = peer
+        Log.debug(f"handshake complete: {peer}")
+        return frames
+
+    def on_push(self, handler: Callable[[dict], None], topics: Iterable[str] = ()):
+        """Botから送られてくる通知(PUSHフレーム)を受け取るハンドラを登録する。
+
+        ``topics`` は接続(再接続)のたびに購読する。
+        """
+        self._push_handlers.append(handler)
+        self._topics.update(topics)
+
+    def on_push_reset(self, handler: Callable[[], None]):
+        """通知を取りこぼした可能性がある時(切断・再接続・番号の欠落)に呼ばれるハンドラを登録する。"""
+        self._reset_handlers.append(handler)
+
+    def is_subscribed(self, *topics: str) -> bool:
+        """指定したトピックの通知を現在受け取れているか。"""
+        return self.connected and self.push_topics.issuperset(topics)
+
+    def stats(self) -> dict:
+        return {
+            "address": self.address,
+            "connected": self.connected,
+            "shard_ids": self.peer.get("shard_ids"),
+            "shard_count": self.peer.get("shard_count"),
+            "push_topics": sorted(self.push_topics),
+            "breaker": self.breaker.stats(),
+            "inflight": self.inflight.stats(),
+        }
+
+    async def _subscribe(self):
+        try:
+            response = await self.send_async({"action": "subscribe", "topics": sorted(self._topics)})
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            Log.warning(f"failed to subscribe to push events: {e}")
             return
 
-        last_exc: Optional[OSError] = None
-        for attempt in range(1, retries + 1):
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        message = response.get("message")
+        if response.get("status") != "ok" or not isinstance(message, dict):
+            Log.warning(f"bot rejected push subscription: {message}")
+            return
+        self.push_topics = set(message.get("topics", []))
+        # 未接続の間の変更は受け取れていないため、購読を始めた時点でキャッシュを捨てる
+        self._reset_push()
+        Log.info(f"subscribed to push events: {sorted(self.push_topics)}")
+
+    def _reset_push(self):
+        for handler in self._reset_handlers:
+            try:
+                handler()
+            except Exception as e:
+                Log.error(f"push reset handler failed: {e}", exc_info=True)
+
+    def _dispatch_push(self, event: dict):
+        Log.debug(f"push -> event: {event}")
+        for handler in self._push_handlers:
+            try:
+                handler(event)
+            except Exception as e:
+                Log.error(f"push handler failed: {e}", exc_info=True)
+
+    def _next_id(self) -> int:
+        # stream_id 0 は接続単位のフレーム用に予約
+        self._last_id = self._last_id % 0xFFFFFFFF + 1
+        return self._last_id
+
+    async def _read_loop(self, reader: asyncio.StreamReader, frames: FrameReader):
+        exc: Exception = ConnectionResetError("connection closed by bot")
+        try:
+            while True:
+                frame = await frames.read_frame()
+                if frame is None:
+                    break
+                if frame.kind not in (Kind.RESPONSE, Kind.PUSH):
+                    Log.warning(f"ignoring unexpected frame kind {frame.kind}")
+                    continue
+
+                try:
+                    response: dict = frame.json()
+                except ValueError as e:
+                    Log.warning(f"dropping malformed frame: {e}")
+                    continue
+
+                if frame.kind == Kind.PUSH:
+                    seq = response.get("seq")
+                    if isinstance(seq, int):
+                        if seq != self._push_seq + 1:
+                            Log.warning(f"push sequence gap: expected {self._push_seq + 1}, got {seq}")
+                            self._reset_push()
+                        self._push_seq = seq
+                    self._dispatch_push(response)
+                    continue
+
+                request_id = frame.stream_id
+                stream = self._streams.get(request_id)
+                if stream is not None:
+                    final = not frame.flags & Flags.PARTIAL
+                    if final:
+                        del self._streams[request_id]
+                    stream.put_nowait((response, final))
+                    continue
+
+                if frame.flags & Flags.PARTIAL:
+                    Log.warning(f"dropping partial response for non-streaming request {request_id}")
+                    continue
+                future = self._pending.pop(request_id, None)
+                if future is None:
+                    Log.warning(f"dropping response for unknown request {request_id}")
+                    continue
+                if not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionError, OSError) as e:
+            exc = e
+            Log.warning(f"connection to bot lost: {e}")
+        finally:
+            if self.reader is reader:
+                self._drop_connection(exc)
+
+    def _drop_connection(self, exc: Exception):
+        writer = self.writer
+        self.reader = None
+        self.writer = None
+        self._reader_task = None
+        self.push_topics = set()
+        self._push_seq = 0
+        if writer is not None:
             try:
-                s.connect((self.ip, self.port))
+                writer.close()
             except OSError as e:
-                last_exc = e
-                s.close()
-                Log.warning(f"connection attempt {attempt}/{retries} failed: {e}")
-                if attempt < retries:
-                    time.sleep(delay)
-                continue
-
-            self.s = s
-            Log.info(f"connected to {self.ip}:{self.port}")
-            return
+                Log.warning(f"error while closing socket: {e}")
+
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
 
-        Log.error(f"failed to connect to {self.ip}:{self.port} after {retries} attempts")
-        if last_exc is not None:
-            raise last_exc
-        raise OSError(f"Could not connect to {self.ip}:{self.port}")
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.put_nowait(exc)
+
+        if writer is not None:
+            self._reset_push()
+            # 再接続してpingに応答するまでは新しいリクエストを受け付けない
+            self.breaker.trip()
+            self._start_recovery()
 
     def close(self):
-        if self.s is None:
-            return
+        self._closed = True
+        task = self._reader_task
+        self._drop_connection(ConnectionResetError("connector closed"))
+        if task is not None:
+            task.cancel()
+        for background in (self._recover_task, self._subscribe_task):
+            if background is not None:
+                background.cancel()
+
+    async def close_async(self):
+        writer = self.writer
+        self.close()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def _stream_attachment(self, writer: asyncio.StreamWriter, request_id: int,
+                                 attachment: AsyncIterator[bytes], future: asyncio.Future):
+        chunk_size = min(self.peer_max_frame_size, MAX_FRAME_SIZE)
+        flags = Flags.END | Flags.ABORT
+        try:
+            async for chunk in attachment:
+                # Bot側が先に応答した場合(拒否など)は残りを送らない
+                if future.done():
+                    break
+                view = memoryview(chunk)
+                for offset in range(0, len(view), chunk_size):
+                    # チャンクごとにロックを取り、他のリクエストのフレームと交互に送れるようにする
+                    async with self._write_lock:
+                        write_frame(writer, Kind.BLOB, view[offset:offset + chunk_size], request_id)
+                        await writer.drain()
+            flags = Flags.END
+        finally:
+            if not writer.is_closing():
+                async with self._write_lock:
+                    write_frame(writer, Kind.BLOB, b"", request_id, flags)
+                    await writer.drain()
+
+    def _forget(self, request_id: int):
+        self._pending.pop(request_id, None)
+        self._streams.pop(request_id, None)
+
+    async def _write_request(self, data: dict, waiters: dict, waiter,
+                             probe: bool = False) -> tuple[asyncio.StreamWriter, int]:
+        """リクエストフレームを書き込み、使用した接続とリクエストIDを返す。
+
+        レスポンスの受け取り先 ``waiter`` はフレームを書き込む前に ``waiters`` に登録する。
+        ヘルスチェック(``probe``)以外は、回路が開いていれば送らずに失敗する。
+        """
+        if not probe:
+            self.ensure_available()
+        writer = self.writer
+        if writer is None or writer.is_closing():
+            raise ConnectorUnavailable("not connected to bot")
+
+        request_id = self._next_id()
+        waiters[request_id] = waiter
+
+        try:
+            async with self._write_lock:
+                Log.debug(f"send -> message: {data}")
+                write_json(writer, Kind.REQUEST, data, request_id, max_frame_size=self.peer_max_frame_size)
+                await writer.drain()
+        except FrameTooLarge:
+            self._forget(request_id)
+            raise
+        except (ConnectionError, OSError) as e:
+            self._forget(request_id)
+            # Bot側には届いていないため、再接続後に呼び出し元が再送してよい
+            Log.warning(f"socket error while sending: {e}")
+            if self.writer is writer:
+                self._drop_connection(e)
+            raise ConnectorUnavailable(f"failed to send request: {e}",
+                                       retry_after=self.breaker.retry_after()) from e
+
+        return writer, request_id
+
+    async def send_async(self, message: str | dict, attachment: Optional[AsyncIterator[bytes]] = None,
+                         timeout: Optional[float] = None) -> dict:
+        """Botへリクエストを送り、同じIDを持つレスポンスを待つ。
+
+        1本の接続上で複数のリクエストを同時に処理でき、レスポンスは順不同で返ってくる。
+        ``COALESCED_ACTIONS`` のリクエストは、処理中の同一リクエストがあればその結果を共有する。
+
+        Args:
+            message (str | dict): リクエスト本体
+            attachment (AsyncIterator[bytes]): リクエストに続けてBLOBフレームで送るバイナリデータ(任意)
+            timeout (float): レスポンスを待つ秒数。省略時は接続のタイムアウトを使う
+        """
+        data = json.loads(message) if isinstance(message, str) else message
+        if attachment is None and data.get("action") in COALESCED_ACTIONS:
+            key = json.dumps(data, sort_keys=True, separators=(",", ":"))
+            return await self.inflight.do(key, lambda: self._request(data, None, timeout))
+        return await self._request(data, attachment, timeout)
+
+    async def _request(self, data: dict, attachment: Optional[AsyncIterator[bytes]],
+                       timeout: Optional[float], probe: bool = False) -> dict:
+        if attachment is not None:
+            data = {**data, "attachment": True}
+
+        future = asyncio.get_running_loop().create_future()
+        writer, request_id = await self._write_request(data, self._pending, future, probe)
+
+        if attachment is not None:
+            try:
+                await self._stream_attachment(writer, request_id, attachment, future)
+            except BaseException:
+                self._forget(request_id)
+                raise
+
         try:
-            self.s.close()
-        except OSError as e:
-            Log.warning(f"error while closing socket: {e}")
+            response = await asyncio.wait_for(future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            if not probe and self.breaker.record_failure():
+                Log.warning(f"bot did not respond {self.breaker.failures} times in a row; opening circuit")
+                self._start_recovery()
+            raise
         finally:
-            self.s = None
+            self._forget(request_id)
+
+        if not probe:
+            self.breaker.record_success()
+        Log.debug(f"recv -> response: {response}")
+        return response
 
-    def ensure_connection(self):
-        if self.s is None:
-            self.connect()
+    async def stream_async(self, message: str | dict, timeout: Optional[float] = None) -> AsyncIterator[dict]:
+        """Botへストリーミング応答を要求し、途中結果を受け取った順に返す。最後に最終レスポンスを返す。
+
+        Args:
+            message (str | dict): リクエスト本体
+            timeout (float): 次の応答を待つ秒数。省略時は接続のタイムアウトを使う
+        """
+        data = json.loads(message) if isinstance(message, str) else message
+        data = {**data, "stream": True}
+
+        queue: asyncio.Queue[Union[tuple[dict, bool], Exception]] = asyncio.Queue()
+        _, request_id = await self._write_request(data, self._streams, queue)
 
-    def send(self, message: str):
-        self.ensure_connection()
-        assert self.s is not None
         try:
-            Log.debug(f"send -> message: {message}")
-            self.s.sendall(message.encode("utf-8"))
-            
-            decoded = self.s.recv(4096).decode()
-            Log.debug(f"recv -> response: {decoded}")
-            return json.loads(decoded)
-        except (BrokenPipeError, ConnectionResetError, OSError) as e:
-            Log.warning(f"socket error while sending, will retry once: {e}")
-            self.close()
-            self.ensure_connection()
-            assert self.s is not None
-            Log.debug(f"send -> message: {message}")
-            self.s.sendall(message.encode("utf-8"))
-
-            decoded = self.s.recv(4096).decode("utf-8")
-            Log.debug(f"recv -> response: {decoded}")
-            return json.loads(decoded)
-
-    async def connect_async(self):
-        return await asyncio.to_thread(self.connect)
-
-    async def send_async(self, message: str):
-        return await asyncio.to_thread(self.send, message)
\ No newline at end of file
+            while True:
+                item = await asyncio.wait_for(queue.get(), timeout or self.timeout)
+                if isinstance(item, Exception):
+                    raise item
+                response, final = item
+                Log.debug(f"recv -> {'response' if final else 'partial'}: {response}")
+                yield response
+                if final:
+                    return
+        finally:
+            self._forget(request_id)
+
+    def send(self, message: str | dict) -> dict:
+        """別スレッドから呼び出すための同期版。接続済みのイベントループ上で実行する。"""
+        if self._loop is None or not self._loop.is_running():
+            raise RuntimeError("Sender is not started; call start() first")
+        future = asyncio.run_coroutine_threadsafe(self.send_async(message), self._loop)
+        return future.result()
@@ -3,8 +3,15 @@ from pydantic import BaseModel
 
 class AnnouncementPayload(BaseModel):
     message: str
+    guild_id: int = int(os.environ.get("GUILD_ID", 0))
     channel_id: int = None if os.environ.get("CHANNEL_ID") is None else int(os.environ.get("CHANNEL_ID"))
     everyone: bool = False
+    run_at: str | None = None
+
+class RecurrencePayload(BaseModel):
+    rrule: str
+    count: int | None = None
+    until: str | None = None
 
 class CreateEventPayload(BaseModel):
     guild_id: int
@@ -16,11 +23,28 @@ class CreateEventPayload(BaseModel):
     entity_type: str = "external"
     location: str | None = None
     image_uri: str | None = None
+    recurrence: RecurrencePayload | None = None
+    run_at: str | None = None
+
+class CreateEventsPayload(BaseModel):
+    events: list[CreateEventPayload]
+    stream: bool = False
  
 class CheckAdminPayload(BaseModel):
     user_id: int
     guild_id: int
  
+class AllowedUserPayload(BaseModel):
+    user_id: int
+    email: str | None = None
+
+class AllowedUsersImportPayload(BaseModel):
+    users: list[AllowedUserPayload]
+    replace: bool = False
+
+class AllowedUsersRemovePayload(BaseModel):
+    user_ids: list[int]
+ 
 class VRCLoginPayload(BaseModel):
     email: str
     password: str
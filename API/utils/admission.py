@@ -0,0 +1,174 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+# Botへの同時リクエスト数と、空きを待てるリクエスト数
+ADMISSION_MAX_INFLIGHT = int(os.environ.get("ADMISSION_MAX_INFLIGHT", 32))
+ADMISSION_MAX_INFLIGHT_PER_USER = int(os.environ.get("ADMISSION_MAX_INFLIGHT_PER_USER", 4))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 128))
+ADMISSION_MAX_QUEUE_PER_USER = int(os.environ.get("ADMISSION_MAX_QUEUE_PER_USER", 8))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 10))
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; the client should retry after ``retry_after`` seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounds the requests waiting on the bot, with a bounded wait queue and per-user fairness.
+
+    When a slot frees up, the waiting users take turns (round robin), so a client that
+    floods the API only ever competes for its own share. Once its queue is full it gets
+    rejected straight away.
+    """
+
+    def __init__(self, max_inflight: int = ADMISSION_MAX_INFLIGHT,
+                 max_inflight_per_user: int = ADMISSION_MAX_INFLIGHT_PER_USER,
+                 max_queue: int = ADMISSION_MAX_QUEUE, max_queue_per_user: int = ADMISSION_MAX_QUEUE_PER_USER,
+                 queue_timeout: float = ADMISSION_QUEUE_TIMEOUT):
+        self.max_inflight = max_inflight
+        self.max_inflight_per_user = max_inflight_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.queued = 0
+        self._inflight_by_user: dict[str, int] = {}
+        # 空きを待っているユーザーごとのキュー。先頭のユーザーから順に空きを割り当てる
+        self._waiting: OrderedDict[str, deque[asyncio.Future]] = OrderedDict()
+        # 1リクエストあたりの処理時間の移動平均 (Retry-Afterの見積もりに使う)
+        self._service_time = 1.0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _has_slot(self, user: str) -> bool:
+        return (
+            self.inflight < self.max_inflight
+            and self._inflight_by_user.get(user, 0) < self.max_inflight_per_user
+        )
+
+    def _grant(self, user: str):
+        self.inflight += 1
+        self._inflight_by_user[user] = self._inflight_by_user.get(user, 0) + 1
+        self.admitted += 1
+
+    def retry_after(self) -> float:
+        # 待っているリクエストが捌けるまでのおおよその秒数
+        return max(1.0, self._service_time * (self.queued + 1) / self.max_inflight)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        raise AdmissionRejected(reason, self.retry_after())
+
+    async def acquire(self, user: Optional[str]):
+        user = user or "anonymous"
+        if user not in self._waiting and self._has_slot(user):
+            self._grant(user)
+            return
+
+        queue = self._waiting.get(user)
+        if self.queued >= self.max_queue:
+            self._reject("too many requests are waiting")
+        if queue is not None and len(queue) >= self.max_queue_per_user:
+            self._reject("too many requests from this user are waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._waiting[user] = deque()
+        queue.append(future)
+        self.queued += 1
+        self.waited += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 割り当てられた直後に呼び出し元が諦めた
+                self.release(user)
+            else:
+                self._discard(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                self._reject("timed out waiting for a free slot")
+            raise
+
+    def _discard(self, user: str, future: asyncio.Future):
+        queue = self._waiting.get(user)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self.queued -= 1
+        if not queue:
+            del self._waiting[user]
+
+    def release(self, user: Optional[str], elapsed: Optional[float] = None):
+        user = user or "anonymous"
+        self.inflight -= 1
+        count = self._inflight_by_user.get(user, 0) - 1
+        if count > 0:
+            self._inflight_by_user[user] = count
+        else:
+            self._inflight_by_user.pop(user, None)
+        if elapsed is not None:
+            self._service_time += (elapsed - self._service_time) * 0.1
+        self._dispatch()
+
+    def _dispatch(self):
+        progressed = True
+        while progressed and self.inflight < self.max_inflight and self._waiting:
+            progressed = False
+            for user in list(self._waiting):
+                if self.inflight >= self.max_inflight:
+                    break
+                if not self._has_slot(user):
+                    continue
+                queue = self._waiting.pop(user)
+                future = queue.popleft()
+                self.queued -= 1
+                if queue:
+                    # 残りがあれば最後尾に回して他のユーザーに順番を譲る
+                    self._waiting[user] = queue
+                progressed = True
+                if future.done():
+                    # タイムアウトでキャンセルされ、まだキューから外されていなかったもの
+                    continue
+                self._grant(user)
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def admit(self, user: Optional[str]) -> AsyncIterator[None]:
+        await self.acquire(user)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user, time.monotonic() - started_at)
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "waiting_users": len(self._waiting),
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "service_time": round(self._service_time, 3),
+            "retry_after": math.ceil(self.retry_after()),
+        }
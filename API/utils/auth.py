@@ -1,17 +1,35 @@
 import os
+import time
+import hashlib
+import secrets
 from authlib.jose import jwt
 from jwcrypto import jwk
 from cryptography.hazmat.primitives import serialization
 
 from utils.logger import Logger
+from utils.cache import TTLCache
 from utils.database import UsersDB
-from connector.sender import Sender
+from utils.admission import AdmissionController
+from connector.router import ConnectorRouter
 
 Log = Logger(__name__)
 
 KEYFILE = "/Secrets/key.pem"
 
+ACCESS_TOKEN_TTL = int(os.environ.get("ACCESS_TOKEN_TTL", 900))
+REFRESH_TOKEN_TTL = int(os.environ.get("REFRESH_TOKEN_TTL", 14 * 24 * 60 * 60))
+JWT_CACHE_TTL = float(os.environ.get("JWT_CACHE_TTL", 300))
+JWT_CACHE_MAXSIZE = int(os.environ.get("JWT_CACHE_MAXSIZE", 4096))
+
 key: bytes | None = None
+public_key = None
+
+# sha256(token) -> 検証済みのclaims
+token_cache = TTLCache(maxsize=JWT_CACHE_MAXSIZE, ttl=JWT_CACHE_TTL)
+
+class AccessRevoked(Exception):
+    """The refresh token was valid, but the user is no longer allowed in."""
+
 
 class AuthUtil:
     @staticmethod
@@ -20,7 +38,9 @@ class AuthUtil:
             password = os.environ.get("JWT_SECRET")
             if password:
                 password = password.encode("utf-8")
-            with open(KEYFILE, "wb") as f:
+            # 複数のワーカーが同時に起動しても鍵が1つに決まるよう、一時ファイルに書いてからリンクする
+            tmpfile = f"{KEYFILE}.{os.getpid()}.tmp"
+            with open(tmpfile, "wb") as f:
                 f.write(
                     jwk.JWK.generate(
                         kty='RSA',
@@ -30,6 +50,12 @@ class AuthUtil:
                         password=password
                     )
                 )
+            try:
+                os.link(tmpfile, KEYFILE)
+            except FileExistsError:
+                Log.info("signing key was generated by another worker")
+            finally:
+                os.remove(tmpfile)
 
     @staticmethod
     def read_key():
@@ -45,6 +71,13 @@ class AuthUtil:
                 )
         return key
 
+    @staticmethod
+    def read_public_key():
+        global public_key
+        if public_key is None:
+            public_key = AuthUtil.read_key().public_key()
+        return public_key
+
     @staticmethod
     def encode(payload: dict) -> str:
         private_key = AuthUtil.read_key()
@@ -55,35 +88,130 @@ class AuthUtil:
         return token
 
     @staticmethod
-    def decode(token: str):
-        public_key = AuthUtil.read_key().public_key()
+    def issue_access_token(user_id: int | str, email: str) -> str:
+        """認可済み(管理者かつ許可リストに登録済み)であることを埋め込んだ短命なアクセストークンを発行する。
+
+        認可の判定は発行時点のものなので、リクエストごとにBotへ問い合わせる必要はない。
+        ロールの変更はトークンの有効期限(ACCESS_TOKEN_TTL)内に反映される。
+        """
+        now = int(time.time())
+        return AuthUtil.encode({
+            "typ": "access",
+            "user_id": str(user_id),
+            "email": email,
+            "admin": True,
+            "allowed": True,
+            "iat": now,
+            "exp": now + ACCESS_TOKEN_TTL,
+        })
+
+    @staticmethod
+    def hash_refresh_token(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    async def issue_refresh_token(user_id: int | str, email: str) -> str:
+        token = secrets.token_urlsafe(32)
+        await UsersDB.add_refresh_token(
+            AuthUtil.hash_refresh_token(token),
+            int(user_id),
+            email,
+            int(time.time()) + REFRESH_TOKEN_TTL
+        )
+        return token
+
+    @staticmethod
+    async def refresh(token: str, sender: ConnectorRouter, admission: AdmissionController) -> tuple[str, str] | None:
+        """リフレッシュトークンを検証し、Botで権限を再確認したうえで新しいトークンの組を返す。
+
+        Returns:
+            tuple: (アクセストークン, リフレッシュトークン)。無効な場合や既に使われた場合はNone。
+
+        Raises:
+            AccessRevoked: ユーザーが権限を失った場合。そのユーザーのリフレッシュトークンは全て破棄される。
+            ConnectorUnavailable: Botに確認できなかった場合。トークンは消費されない。
+            AdmissionRejected: Botへの問い合わせが混み合っている場合。トークンは消費されない。
+        """
+        token_hash = AuthUtil.hash_refresh_token(token)
+        row = await UsersDB.get_refresh_token(token_hash)
+        if row is None:
+            return None
+
+        # 確認できるまではトークンを消費しない
+        user_id, email = row
+        # Botへの問い合わせは他のエンドポイントと同じくユーザーごとに順番待ちさせる
+        async with admission.admit(str(user_id)):
+            allowed = await UsersDB.is_user_allowed(user_id, sender, fresh=True)
+        if not allowed:
+            await UsersDB.remove_refresh_tokens(user_id)
+            raise AccessRevoked(user_id)
+
+        # 同時に更新した他のリクエストが先に使った場合はNone
+        if await UsersDB.pop_refresh_token(token_hash) is None:
+            return None
+
+        return AuthUtil.issue_access_token(user_id, email), await AuthUtil.issue_refresh_token(user_id, email)
+
+    @staticmethod
+    def _normalize(token: str | bytes) -> str:
         if isinstance(token, bytes):
             token = token.decode("utf-8")
         if isinstance(token, str) and token.startswith("b'") and token.endswith("'"):
             token = token[2:-1]
-        return jwt.decode(token, public_key)
+        return token
+
+    @staticmethod
+    def decode(token: str):
+        return jwt.decode(AuthUtil._normalize(token), AuthUtil.read_public_key())
+
+    @staticmethod
+    def decode_verified(token: str):
+        """署名とclaimsを検証したトークンを返す。検証済みのトークンはexpまでキャッシュされる。
+
+        Raises:
+            authlib.jose.errors.JoseError: トークンが不正または期限切れの場合
+        """
+        token = AuthUtil._normalize(token)
+        digest = hashlib.sha256(token.encode("utf-8")).digest()
+        decoded = token_cache.get(digest)
+        if decoded is not None:
+            return decoded
+
+        decoded = AuthUtil.decode(token)
+        decoded.validate()
+
+        ttl = JWT_CACHE_TTL
+        exp = decoded.get("exp")
+        if exp is not None:
+            ttl = min(ttl, float(exp) - time.time())
+        token_cache.set(digest, decoded, ttl=ttl)
+        return decoded
 
     @staticmethod
     def verify(token: str):
         try:
-            decoded = jwt.decode(token, AuthUtil.read_key().public_key())
-            decoded.validate()
+            AuthUtil.decode_verified(token)
             return True
         except Exception as e:
             Log.error(f"Token verification failed: {e}")
             return False
 
     @staticmethod
-    async def verify_user(token: str, sender: Sender) -> bool:
+    def caller(token: str) -> str | None:
+        """Botが呼び出し元ごとに順番待ちを分けるためのユーザーID。検証済みのトークンにのみ使う。"""
         try:
-            decoded = AuthUtil.decode(token)
-            decoded.validate()
+            return AuthUtil.decode_verified(token).get("user_id")
         except Exception:
-            return False
+            return None
 
-        user_id = int(decoded.get("user_id", 0))
+    @staticmethod
+    async def verify_user(token: str, sender: ConnectorRouter) -> bool:
         try:
-            return await UsersDB.is_user_allowed(user_id, sender)
-        except Exception as exc:
-            Log.error(f"Error verifying user: {exc}", exc_info=True)
-            return False
\ No newline at end of file
+            decoded = AuthUtil.decode_verified(token)
+        except Exception:
+            return False
+
+        # 認可はアクセストークン発行時に済んでいるため、ここではI/Oを行わない
+        if decoded.get("typ") != "access" or decoded.get("exp") is None:
+            return False
+        return bool(decoded.get("admin")) and bool(decoded.get("allowed"))
\ No newline at end of file
@@ -1,74 +1,248 @@
-import aiosqlite
 import os
 import json
+import time
 
 from utils.logger import Logger
-from connector.sender import Sender
+from utils.cache import TTLCache
+from utils.sqlite import Repository
+from utils.state import state_backend
+from connector.breaker import ConnectorUnavailable
+from connector.router import ConnectorRouter
 
 Log = Logger(__name__)
-USERS_DB_PATH = "/Database/users.db"
 
-class UsersDB:
+ADMIN_CACHE_TTL = float(os.environ.get("ADMIN_CACHE_TTL", 60))
+ADMIN_CACHE_NEGATIVE_TTL = float(os.environ.get("ADMIN_CACHE_NEGATIVE_TTL", 10))
+ADMIN_CACHE_MAXSIZE = int(os.environ.get("ADMIN_CACHE_MAXSIZE", 4096))
+# Botからロール・メンバーの変更通知を受け取れている間のキャッシュ秒数
+ADMIN_CACHE_PUSH_TTL = float(os.environ.get("ADMIN_CACHE_PUSH_TTL", 3600))
+# 許可リストを変更するたびに増やす番号。他のワーカーはこれを見てallowed_indexを読み直す
+ALLOWED_USERS_VERSION_KEY = "allowed_users_version"
+# 番号を確認する最短の間隔。他のワーカーでの変更はこの秒数以内に反映される
+ALLOWED_USERS_SYNC_INTERVAL = float(os.environ.get("ALLOWED_USERS_SYNC_INTERVAL", 1))
+
+class UsersDB(Repository):
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS allowed_users (
+            user_id INTEGER NOT NULL,
+            email TEXT,
+            PRIMARY KEY (user_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            token_hash TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            email TEXT,
+            expires_at INTEGER NOT NULL,
+            PRIMARY KEY (token_hash)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS refresh_tokens_user_id ON refresh_tokens (user_id);",
+    )
+
+    # 管理者キャッシュを正しく保つために購読する通知
+    PUSH_TOPICS = ("members", "roles")
+
+    # (user_id, guild_id) -> is_admin
+    admin_cache = TTLCache(maxsize=ADMIN_CACHE_MAXSIZE, ttl=ADMIN_CACHE_TTL)
+    # allowed_usersテーブルのuser_idをメモリ上に保持する (書き込みはこのクラス経由のみ)
+    allowed_index: set[int] = set()
+    allowed_version = 0
+    allowed_checked_at = 0.0
+
     @staticmethod
     async def init_db():
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS allowed_users (
-                    user_id INTEGER NOT NULL,
-                    email TEXT,
-                    PRIMARY KEY (user_id)
-                );
-            """)
-            await db.commit()
+        await UsersDB.init_schema()
+        await UsersDB.load_allowed_index()
+
+    @staticmethod
+    async def load_allowed_index():
+        # 読み込み中に変更された場合に次回読み直せるよう、番号を先に取得する
+        version = await state_backend.get(ALLOWED_USERS_VERSION_KEY) or 0
+        rows = await UsersDB.fetchall("SELECT user_id FROM allowed_users")
+        UsersDB.allowed_index = {row[0] for row in rows}
+        UsersDB.allowed_version = version
+        Log.info(f"loaded {len(UsersDB.allowed_index)} allowed users (version {version})")
+
+    @staticmethod
+    async def sync_allowed_index():
+        """他のワーカーが許可リストを変更していれば読み直す。確認は最大でもALLOWED_USERS_SYNC_INTERVALごとに1回。"""
+        now = time.monotonic()
+        if now - UsersDB.allowed_checked_at < ALLOWED_USERS_SYNC_INTERVAL:
+            return
+        # 確認中に届いた他のリクエストも待たせずにメモリ上の一覧で答える
+        UsersDB.allowed_checked_at = now
+        version = await state_backend.get(ALLOWED_USERS_VERSION_KEY) or 0
+        if version != UsersDB.allowed_version:
+            await UsersDB.load_allowed_index()
+
+    @staticmethod
+    async def _bump_allowed_version():
+        version = await state_backend.incr(ALLOWED_USERS_VERSION_KEY)
+        # 自分の変更だけであれば読み直す必要はない
+        if version == UsersDB.allowed_version + 1:
+            UsersDB.allowed_version = version
     
     @staticmethod
-    async def get_allowed_users() -> dict:
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            cursor = await db.execute("SELECT user_id FROM allowed_users")
-            rows = await cursor.fetchall()
-            await cursor.close()
-            return [{"user_id": row[0]} for row in rows]
+    async def get_allowed_users() -> list[dict]:
+        rows = await UsersDB.fetchall("SELECT user_id, email FROM allowed_users ORDER BY user_id")
+        return [{"user_id": row[0], "email": row[1]} for row in rows]
 
     @staticmethod
     async def add_allowed_user(user_id: int, email: str):
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            await db.execute("INSERT INTO allowed_users (user_id, email) VALUES (?, ?)", (user_id, email))
-            await db.commit()
+        await UsersDB.execute("INSERT INTO allowed_users (user_id, email) VALUES (?, ?)", (user_id, email))
+        UsersDB.allowed_index.add(user_id)
+        await UsersDB._bump_allowed_version()
+
+    @staticmethod
+    async def import_allowed_users(users: list[tuple[int, str | None]], replace: bool = False) -> int:
+        """許可ユーザーを1トランザクションでまとめて登録する。
+
+        Args:
+            users (list): (user_id, email) のリスト。既存のユーザーはemailを更新する。
+            replace (bool): Trueの場合は既存の許可ユーザーを全て置き換える。
+
+        Returns:
+            int: 登録したユーザー数
+        """
+        async with UsersDB.transaction() as db:
+            if replace:
+                await db.execute("DELETE FROM allowed_users")
+            await db.executemany(
+                """
+                INSERT INTO allowed_users (user_id, email) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET email = excluded.email
+                """,
+                users
+            )
+
+        user_ids = {user_id for user_id, _ in users}
+        if replace:
+            UsersDB.allowed_index = user_ids
+        else:
+            UsersDB.allowed_index |= user_ids
+        await UsersDB._bump_allowed_version()
+        return len(user_ids)
+
+    @staticmethod
+    async def remove_allowed_users(user_ids: list[int]) -> int:
+        async with UsersDB.transaction() as db:
+            cursor = await db.executemany("DELETE FROM allowed_users WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+            removed = cursor.rowcount
+            await cursor.close()
+
+        UsersDB.allowed_index.difference_update(user_ids)
+        await UsersDB._bump_allowed_version()
+        return removed
     
     @staticmethod
-    async def remove_allowed_user(user_id: int, guild_id: int):
-        async with aiosqlite.connect(USERS_DB_PATH) as db:
-            await db.execute("DELETE FROM allowed_users WHERE user_id = ? AND guild_id = ?", (user_id, guild_id))
-            await db.commit()
+    async def remove_allowed_user(user_id: int):
+        await UsersDB.remove_allowed_users([user_id])
     
     @staticmethod
-    async def is_user_allowed(user_id: int, sender: Sender) -> bool:
+    async def add_refresh_token(token_hash: str, user_id: int, email: str, expires_at: int):
+        async with UsersDB.transaction() as db:
+            await db.execute("DELETE FROM refresh_tokens WHERE expires_at <= ?", (int(time.time()),))
+            await db.execute(
+                "INSERT INTO refresh_tokens (token_hash, user_id, email, expires_at) VALUES (?, ?, ?, ?)",
+                (token_hash, user_id, email, expires_at)
+            )
+
+    @staticmethod
+    async def get_refresh_token(token_hash: str) -> tuple[int, str] | None:
+        """リフレッシュトークンを消費せずに参照する。期限切れの場合はNoneを返す。"""
+        row = await UsersDB.fetchone(
+            "SELECT user_id, email FROM refresh_tokens WHERE token_hash = ? AND expires_at > ?",
+            (token_hash, int(time.time()))
+        )
+        return None if row is None else (row[0], row[1])
+
+    @staticmethod
+    async def pop_refresh_token(token_hash: str) -> tuple[int, str] | None:
+        """リフレッシュトークンを取り出して削除する(使い回し防止)。期限切れの場合はNoneを返す。"""
+        async with UsersDB.transaction() as db:
+            cursor = await db.execute(
+                "DELETE FROM refresh_tokens WHERE token_hash = ? RETURNING user_id, email, expires_at",
+                (token_hash,)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+
+        if row is None or row[2] <= int(time.time()):
+            return None
+        return row[0], row[1]
+
+    @staticmethod
+    async def remove_refresh_tokens(user_id: int):
+        await UsersDB.execute("DELETE FROM refresh_tokens WHERE user_id = ?", (user_id,))
+
+    @staticmethod
+    def flush_admin_cache():
+        UsersDB.admin_cache.clear()
+
+    @staticmethod
+    def apply_push(event: dict):
+        """Botからのロール変更通知を受けて管理者キャッシュを無効化する。"""
+        guild_id = event.get("guild_id")
+        match event.get("event"):
+            case "member_update" | "member_remove":
+                UsersDB.admin_cache.pop((int(event.get("user_id", 0)), int(guild_id or 0)))
+            case "guild_roles_update":
+                UsersDB.admin_cache.discard_where(lambda key: key[1] == int(guild_id or 0))
+
+    @staticmethod
+    async def check_admin(user_id: int, guild_id: int, sender: ConnectorRouter) -> bool:
+        key = (user_id, guild_id)
+        cached = UsersDB.admin_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result: dict = await sender.send_async(
+            json.dumps({
+                "action": "check_admin",
+                "user_id": user_id,
+                "guild_id": guild_id
+            })
+        )
+
+        message = result.get("message")
+        # busyやBot側のエラーは権限がないという答えではないため、拒否として扱わない
+        if result.get("status") != "ok" or not isinstance(message, dict):
+            raise ConnectorUnavailable(f"admin check failed: {result.get('status')}: {message}")
+
+        is_admin = bool(message.get("is_admin", False))
+        if sender.is_subscribed(*UsersDB.PUSH_TOPICS):
+            # 変更は通知で無効化されるため長く保持できる
+            ttl = ADMIN_CACHE_PUSH_TTL
+        else:
+            ttl = ADMIN_CACHE_TTL if is_admin else ADMIN_CACHE_NEGATIVE_TTL
+        UsersDB.admin_cache.set(key, is_admin, ttl=ttl)
+        return is_admin
+
+    @staticmethod
+    async def is_user_allowed(user_id: int, sender: ConnectorRouter, fresh: bool = False) -> bool:
+        """許可リストにあり、Botが管理者だと答えた場合にTrue。
+
+        Falseは確定した拒否の場合のみ返す。Botに確認できなかった場合はConnectorUnavailableを送出する。
+        """
+        await UsersDB.sync_allowed_index()
+        # 許可リストにないユーザーはBotに問い合わせるまでもない
+        if user_id not in UsersDB.allowed_index:
+            return False
+
         try:
             guild_id = int(os.environ.get("GUILD_ID", 0)) # GuildIDはいつか可変にするかも
-            result: dict = await sender.send_async(
-                json.dumps({
-                    "action": "check_admin",
-                    "user_id": user_id,
-                    "guild_id": guild_id
-                })
-            )
+            if fresh:
+                UsersDB.admin_cache.pop((user_id, guild_id))
+            is_admin = await UsersDB.check_admin(user_id, guild_id, sender)
+        except ConnectorUnavailable:
+            # Botが止まっている間は拒否ではなく503として呼び出し元に伝える
+            raise
         except Exception as e:
+            # タイムアウトなども拒否ではないため、同じく503として伝える
             Log.error(f"Error checking admin status: {e}", exc_info=True)
-            return False
+            raise ConnectorUnavailable(f"admin check failed: {e}") from e
 
-        message = result.get("message")
-        is_admin = False
-        if message and isinstance(message, dict):
-            is_admin = message.get("is_admin", False)
-            
-        if is_admin:
-            async with aiosqlite.connect(USERS_DB_PATH) as db:
-                cursor = await db.execute(
-                    "SELECT 1 FROM allowed_users WHERE user_id = ?",
-                    (user_id,)
-                )
-                row = await cursor.fetchone()
-                await cursor.close()
-                return row is not None
-            
-        return False
\ No newline at end of file
+        return is_admin
\ No newline at end of file
@@ -0,0 +1,87 @@
+import aiohttp
+import os
+from typing import Optional
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", 10))
+HTTP_DNS_TTL = int(os.environ.get("HTTP_DNS_TTL", 300))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 10))
+
+
+class HTTPClient:
+    """Process-wide aiohttp session so outbound requests reuse pooled keep-alive connections."""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP client is not started")
+        return self._session
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_connection_create_end.append(self._on_connection_create)
+        trace.on_connection_reuseconn.append(self._on_connection_reuse)
+
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            trace_configs=[trace],
+        )
+        Log.info(f"HTTP client started (limit={HTTP_POOL_LIMIT}, per_host={HTTP_POOL_LIMIT_PER_HOST})")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _on_request_start(self, session, ctx, params):
+        self.requests += 1
+
+    async def _on_connection_create(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuse(self, session, ctx, params):
+        self.connections_reused += 1
+
+    def stats(self) -> dict:
+        stats = {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+        }
+        if self._session is not None and not self._session.closed:
+            connector = self._session.connector
+            stats.update({
+                "limit": connector.limit,
+                "limit_per_host": connector.limit_per_host,
+                # aiohttpは公開APIを持たないため内部属性から数える
+                "acquired": len(getattr(connector, "_acquired", ())),
+                "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()),
+            })
+        return stats
+
+
+http_client = HTTPClient()
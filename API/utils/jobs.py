@@ -0,0 +1,328 @@
+import asyncio
+import json
+import os
+import random
+import secrets
+import time
+from typing import Optional
+
+from utils.logger import Logger
+from utils.sqlite import Repository
+from connector.breaker import ConnectorUnavailable
+from connector.router import ConnectorRouter
+
+Log = Logger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# Bot側のタイムアウト(create_eventは60秒)に加えて、MUTATINGレーンでの順番待ちも含めて待つ
+JOB_SEND_TIMEOUT = float(os.environ.get("JOB_SEND_TIMEOUT", 300))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", JOB_SEND_TIMEOUT + 60))
+JOB_BACKOFF_BASE = float(os.environ.get("JOB_BACKOFF_BASE", 5))
+JOB_BACKOFF_MAX = float(os.environ.get("JOB_BACKOFF_MAX", 600))
+JOB_POLL_INTERVAL = 5.0
+
+
+class JobsDB(Repository):
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            run_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            lease_owner TEXT,
+            lease_until REAL,
+            last_error TEXT,
+            result TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);",
+        """
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            job_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at REAL NOT NULL,
+            PRIMARY KEY (job_id)
+        );
+        """,
+    )
+
+    @staticmethod
+    async def enqueue(action: str, payload: dict, run_at: Optional[float] = None,
+                      max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        now = time.time()
+        async with JobsDB.transaction() as db:
+            cursor = await db.execute(
+                """
+                INSERT INTO jobs (action, payload, run_at, max_attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (action, json.dumps(payload), run_at or now, max_attempts, now, now)
+            )
+            job_id = cursor.lastrowid
+            await cursor.close()
+        return job_id
+
+    @staticmethod
+    async def claim(owner: str, lease: float = JOB_LEASE_SECONDS) -> dict | None:
+        """実行時刻を過ぎたジョブ(またはリースが切れた実行中のジョブ)を1件取り出してリースする。"""
+        now = time.time()
+        async with JobsDB.transaction() as db:
+            cursor = await db.execute(
+                """
+                UPDATE jobs
+                SET status = 'running', lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?
+                WHERE job_id = (
+                    SELECT job_id FROM jobs
+                    WHERE (status = 'queued' AND run_at <= ?) OR (status = 'running' AND lease_until < ?)
+                    ORDER BY run_at LIMIT 1
+                )
+                RETURNING job_id, action, payload, attempts, max_attempts
+                """,
+                (owner, now + lease, now, now, now)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "action": row[1],
+            "payload": json.loads(row[2]),
+            "attempts": row[3],
+            "max_attempts": row[4],
+        }
+
+    @staticmethod
+    async def next_run_at() -> float | None:
+        row = await JobsDB.fetchone("SELECT MIN(run_at) FROM jobs WHERE status = 'queued'")
+        return row[0] if row else None
+
+    @staticmethod
+    async def complete(job_id: int, owner: str, result) -> bool:
+        # リースを他のワーカーに取られていた場合は結果を書き込まない
+        return await JobsDB.execute(
+            """
+            UPDATE jobs SET status = 'succeeded', result = ?, lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE job_id = ? AND lease_owner = ?
+            """,
+            (json.dumps(result), time.time(), job_id, owner)
+        ) > 0
+
+    @staticmethod
+    async def retry(job_id: int, owner: str, error: str, delay: float) -> bool:
+        now = time.time()
+        return await JobsDB.execute(
+            """
+            UPDATE jobs SET status = 'queued', run_at = ?, last_error = ?, lease_owner = NULL, lease_until = NULL,
+                updated_at = ?
+            WHERE job_id = ? AND lease_owner = ?
+            """,
+            (now + delay, error, now, job_id, owner)
+        ) > 0
+
+    @staticmethod
+    async def defer(job_id: int, owner: str, error: str, delay: float) -> bool:
+        """送信できなかったジョブを試行回数を消費せずに戻す。"""
+        now = time.time()
+        return await JobsDB.execute(
+            """
+            UPDATE jobs SET status = 'queued', run_at = ?, last_error = ?, attempts = attempts - 1,
+                lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE job_id = ? AND lease_owner = ?
+            """,
+            (now + delay, error, now, job_id, owner)
+        ) > 0
+
+    @staticmethod
+    async def bury(job_id: int, owner: str, error: str, result=None, status: str = "failed") -> bool:
+        """ジョブを失敗(または結果不明の"unknown")として終了し、確認できるようdead_lettersに移す。"""
+        now = time.time()
+        async with JobsDB.transaction() as db:
+            cursor = await db.execute(
+                """
+                UPDATE jobs SET status = ?, last_error = ?, result = ?, lease_owner = NULL, lease_until = NULL,
+                    updated_at = ?
+                WHERE job_id = ? AND lease_owner = ?
+                RETURNING action, payload, attempts
+                """,
+                (status, error, None if result is None else json.dumps(result), now, job_id, owner)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+            if row is None:
+                return False
+            await db.execute(
+                """
+                INSERT OR REPLACE INTO dead_letters (job_id, action, payload, attempts, last_error, failed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (job_id, row[0], row[1], row[2], error, now)
+            )
+        return True
+
+    @staticmethod
+    async def get_job(job_id: int) -> dict | None:
+        row = await JobsDB.fetchone(
+            """
+            SELECT job_id, action, status, run_at, attempts, max_attempts, last_error, result, created_at, updated_at
+            FROM jobs WHERE job_id = ?
+            """,
+            (job_id,)
+        )
+        if row is None:
+            return None
+        return {
+            "job_id": row[0],
+            "action": row[1],
+            "status": row[2],
+            "run_at": row[3],
+            "attempts": row[4],
+            "max_attempts": row[5],
+            "last_error": row[6],
+            "result": None if row[7] is None else json.loads(row[7]),
+            "created_at": row[8],
+            "updated_at": row[9],
+        }
+
+    @staticmethod
+    async def counts() -> dict:
+        rows = await JobsDB.fetchall("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        counts = {row[0]: row[1] for row in rows}
+        row = await JobsDB.fetchone("SELECT COUNT(*) FROM dead_letters")
+        counts["dead_letters"] = row[0] if row else 0
+        return counts
+
+
+def backoff(attempts: int) -> float:
+    """指数バックオフ。同時に失敗したジョブの再試行が揃わないよう揺らぎを加える。"""
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class JobQueue:
+    """Runs queued jobs against the bot with leased workers.
+
+    Delivery is at-least-once: a job whose worker dies, or whose response is lost after
+    the bot received it, is run again once its lease expires or its backoff elapses. Every
+    attempt carries the job's idempotency key and only goes to the bot that owns the guild,
+    which records the keys it has received. A repeat is answered with the first result (or
+    ``unknown`` if that bot stopped mid-way) even across a restart of that bot. Dedupe is per
+    bot instance only: if the guild moves to another bot (resharding, a changed address
+    list) or the bot loses its cache volume, a retry can still post twice.
+    """
+
+    def __init__(self, sender: ConnectorRouter, workers: int = JOB_WORKERS):
+        self.sender = sender
+        self.workers = workers
+        self.owner = secrets.token_hex(8)
+        self._tasks: list[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work(index)) for index in range(self.workers)]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def enqueue(self, action: str, payload: dict, run_at: Optional[float] = None) -> int:
+        job_id = await JobsDB.enqueue(action, payload, run_at)
+        self._wakeup.set()
+        return job_id
+
+    async def _work(self, index: int):
+        owner = f"{self.owner}-{index}"
+        while True:
+            if not self.sender.available:
+                # Botに届かない間は取り出さない (試行回数を消費させない)
+                await asyncio.sleep(min(JOB_POLL_INTERVAL, max(0.1, self.sender.retry_after())))
+                continue
+
+            try:
+                job = await JobsDB.claim(owner)
+            except Exception as e:
+                Log.error(f"failed to claim job: {e}", exc_info=True)
+                job = None
+
+            if job is None:
+                await self._sleep()
+                continue
+
+            try:
+                await self._run(job, owner)
+            except asyncio.CancelledError:
+                # リースが切れた後に他のワーカー(または再起動後)が再実行する
+                raise
+            except Exception as e:
+                Log.error(f"job {job['job_id']} crashed: {e}", exc_info=True)
+
+    async def _sleep(self):
+        timeout = JOB_POLL_INTERVAL
+        try:
+            next_run_at = await JobsDB.next_run_at()
+        except Exception as e:
+            Log.warning(f"failed to read next job time: {e}")
+            next_run_at = None
+        if next_run_at is not None:
+            timeout = min(timeout, max(0.0, next_run_at - time.time()))
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self, job: dict, owner: str):
+        job_id = job["job_id"]
+        try:
+            response: dict = await self.sender.send_async(
+                {"action": job["action"], **job["payload"], "idempotency_key": f"job:{job_id}"},
+                timeout=JOB_SEND_TIMEOUT
+            )
+        except ConnectorUnavailable as e:
+            # 担当のBotに送れなかった (他のBotには回さない)。送っていないため試行回数には数えない
+            await JobsDB.defer(job_id, owner, str(e), max(1.0, e.retry_after))
+            return
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            # 届いていた場合も、再試行は同じキーで同じBotに送るため、そのBotが覚えている間は二重に実行されない
+            await self._fail(job, owner, f"{type(e).__name__}: {e}")
+            return
+
+        match response.get("status"):
+            case "ok":
+                await JobsDB.complete(job_id, owner, response)
+                Log.info(f"job {job_id} ({job['action']}) succeeded")
+            case "busy":
+                await self._fail(job, owner, str(response.get("message")))
+            case "unknown":
+                # Bot側で打ち切られたが、Discordには反映されている場合がある。再試行すると二重になり得るため終了する
+                await JobsDB.bury(job_id, owner, str(response.get("message")), response, status="unknown")
+                Log.warning(f"job {job_id} ({job['action']}) outcome is unknown: {response.get('message')}")
+            case _:
+                # Bot側で処理した上でのエラーは再試行しても結果が変わらない
+                await JobsDB.bury(job_id, owner, str(response.get("message")), response)
+                Log.warning(f"job {job_id} ({job['action']}) failed: {response.get('message')}")
+
+    async def _fail(self, job: dict, owner: str, error: str):
+        job_id = job["job_id"]
+        if job["attempts"] >= job["max_attempts"]:
+            await JobsDB.bury(job_id, owner, error)
+            Log.error(f"job {job_id} ({job['action']}) gave up after {job['attempts']} attempts: {error}")
+            return
+
+        delay = backoff(job["attempts"])
+        await JobsDB.retry(job_id, owner, error, delay)
+        Log.warning(f"job {job_id} ({job['action']}) attempt {job['attempts']} failed, retrying in {delay:.1f}s: {error}")
@@ -0,0 +1,349 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from dateutil.parser import isoparse
+from dateutil.rrule import rrule, rrulestr
+
+from utils.logger import Logger
+from utils.sqlite import Repository
+from utils.state import state_backend
+from connector.breaker import ConnectorUnavailable
+from connector.router import ConnectorRouter
+
+Log = Logger(__name__)
+
+# 各シリーズについて、常にDiscord上に作成済みにしておく今後の回数
+SERIES_LOOKAHEAD = int(os.environ.get("SERIES_LOOKAHEAD", 4))
+SERIES_INTERVAL = float(os.environ.get("SERIES_INTERVAL", 600))
+# Bot側のcreate_eventsのタイムアウト(900秒)と順番待ちの時間を合わせたもの
+SERIES_CREATE_TIMEOUT = 960
+SERIES_LEASE = "series_scheduler"
+
+
+def parse_time(value: str, name: str) -> datetime:
+    try:
+        parsed = isoparse(value)
+    except ValueError as e:
+        raise ValueError(f"{name} is not a valid ISO 8601 time") from e
+    if parsed.tzinfo is None:
+        raise ValueError(f"{name} must include a UTC offset")
+    return parsed
+
+
+def build_rule(rule: str, dtstart: datetime, count: Optional[int] = None, until: Optional[str] = None) -> rrule:
+    """RRULE文字列を展開可能なrruleにする。count/untilはRRULE内の指定より優先する。"""
+    if count is not None and until is not None:
+        raise ValueError("count and until are mutually exclusive")
+
+    try:
+        parsed = rrulestr(rule, dtstart=dtstart)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid RRULE: {e}") from e
+    if not isinstance(parsed, rrule):
+        raise ValueError("Only a single RRULE is supported")
+
+    if count is not None:
+        parsed = parsed.replace(count=count, until=None)
+    elif until is not None:
+        parsed = parsed.replace(count=None, until=parse_time(until, "until"))
+    elif "COUNT=" not in rule.upper() and "UNTIL=" not in rule.upper():
+        raise ValueError("A recurrence needs a count or an until date")
+    return parsed
+
+
+class SeriesDB(Repository):
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS event_series (
+            series_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            template TEXT NOT NULL,
+            rrule TEXT NOT NULL,
+            dtstart TEXT NOT NULL,
+            duration INTEGER NOT NULL,
+            count INTEGER,
+            until TEXT,
+            active INTEGER NOT NULL DEFAULT 1,
+            created_at INTEGER NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS series_occurrences (
+            series_id INTEGER NOT NULL REFERENCES event_series (series_id) ON DELETE CASCADE,
+            start_ts INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            message TEXT,
+            PRIMARY KEY (series_id, start_ts)
+        );
+        """,
+    )
+
+    @staticmethod
+    def rule(series: dict) -> rrule:
+        return build_rule(series["rrule"], isoparse(series["dtstart"]), series["count"], series["until"])
+
+    @staticmethod
+    async def create_series(guild_id: int, template: dict, rule: str, start_time: str, end_time: Optional[str],
+                            count: Optional[int] = None, until: Optional[str] = None) -> int:
+        dtstart = parse_time(start_time, "start_time")
+        duration = timedelta(hours=1)
+        if end_time is not None:
+            duration = parse_time(end_time, "end_time") - dtstart
+            if duration <= timedelta(0):
+                raise ValueError("end_time must be after start_time")
+
+        # 保存する前に展開できることを確認する
+        build_rule(rule, dtstart, count, until)
+
+        async with SeriesDB.transaction() as db:
+            cursor = await db.execute(
+                """
+                INSERT INTO event_series (guild_id, template, rrule, dtstart, duration, count, until, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (guild_id, json.dumps(template), rule, dtstart.isoformat(), int(duration.total_seconds()),
+                 count, until, int(time.time()))
+            )
+            series_id = cursor.lastrowid
+            await cursor.close()
+        return series_id
+
+    @staticmethod
+    def _to_dict(row: tuple) -> dict:
+        return {
+            "series_id": row[0],
+            "guild_id": row[1],
+            "template": json.loads(row[2]),
+            "rrule": row[3],
+            "dtstart": row[4],
+            "duration": row[5],
+            "count": row[6],
+            "until": row[7],
+            "active": bool(row[8]),
+        }
+
+    @staticmethod
+    async def get_series(series_id: int) -> dict | None:
+        row = await SeriesDB.fetchone(
+            """
+            SELECT series_id, guild_id, template, rrule, dtstart, duration, count, until, active
+            FROM event_series WHERE series_id = ?
+            """,
+            (series_id,)
+        )
+        return None if row is None else SeriesDB._to_dict(row)
+
+    @staticmethod
+    async def get_series_list(active_only: bool = False) -> list[dict]:
+        rows = await SeriesDB.fetchall(
+            f"""
+            SELECT series_id, guild_id, template, rrule, dtstart, duration, count, until, active
+            FROM event_series {"WHERE active = 1" if active_only else ""} ORDER BY series_id
+            """
+        )
+        return [SeriesDB._to_dict(row) for row in rows]
+
+    @staticmethod
+    async def finish_series(series_id: int) -> bool:
+        return await SeriesDB.execute("UPDATE event_series SET active = 0 WHERE series_id = ?", (series_id,)) > 0
+
+    @staticmethod
+    async def get_occurrences(series_id: int, since: int = 0) -> dict[int, str]:
+        """start_ts -> status"""
+        rows = await SeriesDB.fetchall(
+            "SELECT start_ts, status FROM series_occurrences WHERE series_id = ? AND start_ts > ?",
+            (series_id, since)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    @staticmethod
+    async def claim_occurrences(series_id: int, starts: list[int]) -> list[int]:
+        """作成予定の回を登録し、他の処理に先に登録されていなかったものだけを返す。"""
+        claimed = []
+        async with SeriesDB.transaction() as db:
+            for start_ts in starts:
+                cursor = await db.execute(
+                    "INSERT OR IGNORE INTO series_occurrences (series_id, start_ts, status) VALUES (?, ?, 'pending')",
+                    (series_id, start_ts)
+                )
+                if cursor.rowcount:
+                    claimed.append(start_ts)
+                await cursor.close()
+        return claimed
+
+    @staticmethod
+    async def settle_occurrences(series_id: int, results: list[tuple[int, str, str]]):
+        """(start_ts, status, message) を記録する。"""
+        await SeriesDB.executemany(
+            "UPDATE series_occurrences SET status = ?, message = ? WHERE series_id = ? AND start_ts = ?",
+            [(status, message, series_id, start_ts) for start_ts, status, message in results]
+        )
+
+    @staticmethod
+    async def release_occurrences(series_id: int, starts: list[int]):
+        await SeriesDB.executemany(
+            "DELETE FROM series_occurrences WHERE series_id = ? AND start_ts = ? AND status = 'pending'",
+            [(series_id, start_ts) for start_ts in starts]
+        )
+
+
+class SeriesScheduler:
+    """Keeps the next few occurrences of every active series created on Discord.
+
+    Occurrences are expanded lazily from the RRULE on each pass and recorded once claimed,
+    so each one costs a single Discord call no matter how often the scheduler runs. An
+    occurrence whose outcome the bot never reported is kept as ``unknown`` rather than
+    created again, since the bot may have created it anyway.
+    """
+
+    def __init__(self, sender: ConnectorRouter, lookahead: int = SERIES_LOOKAHEAD, interval: float = SERIES_INTERVAL):
+        self.sender = sender
+        self.lookahead = lookahead
+        self.interval = interval
+        self.owner = secrets.token_hex(8)
+        self._task: Optional[asyncio.Task] = None
+        self._locks: dict[int, asyncio.Lock] = {}
+        # Botの応答を待っている作成リクエスト
+        self._sends: set[asyncio.Task] = set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # 応答を待っている回は結果不明として記録させる
+        for send in list(self._sends):
+            send.cancel()
+        await asyncio.gather(*self._sends, return_exceptions=True)
+        if task is not None:
+            await state_backend.release_lease(SERIES_LEASE, self.owner)
+
+    async def _run(self):
+        while True:
+            try:
+                # 複数のワーカーが起動していても巡回はリースを持つ1つだけが行う。止まれば期限切れ後に他が引き継ぐ
+                if await state_backend.acquire_lease(SERIES_LEASE, self.owner, self.interval * 2):
+                    await self.run_once()
+            except Exception as e:
+                Log.error(f"series scheduler pass failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        for series in await SeriesDB.get_series_list(active_only=True):
+            try:
+                await self.extend(series)
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                # Botに届かない場合は次の周期で再試行する
+                Log.warning(f"could not extend series {series['series_id']}: {e}")
+                return
+
+    async def extend(self, series: dict) -> int:
+        """未作成の今後の回を作成し、作成できた数を返す。"""
+        series_id = series["series_id"]
+        lock = self._locks.setdefault(series_id, asyncio.Lock())
+        async with lock:
+            now = datetime.now(timezone.utc)
+            existing = await SeriesDB.get_occurrences(series_id, since=int(now.timestamp()))
+            need = self.lookahead - sum(1 for status in existing.values() if status != "failed")
+            if need <= 0:
+                return 0
+
+            starts: list[datetime] = []
+            exhausted = True
+            for start in SeriesDB.rule(series).xafter(now, inc=False):
+                if int(start.timestamp()) in existing:
+                    continue
+                if len(starts) == need:
+                    exhausted = False
+                    break
+                starts.append(start)
+
+            created = await self._create(series, starts) if starts else 0
+            if exhausted:
+                Log.info(f"series {series_id} has no further occurrences")
+                await SeriesDB.finish_series(series_id)
+            return created
+
+    async def _create(self, series: dict, starts: list[datetime]) -> int:
+        series_id = series["series_id"]
+        by_ts = {int(start.timestamp()): start for start in starts}
+        claimed = await SeriesDB.claim_occurrences(series_id, list(by_ts))
+        if not claimed:
+            return 0
+
+        duration = timedelta(seconds=series["duration"])
+        events = [
+            {
+                **series["template"],
+                "start_time": by_ts[start_ts].isoformat(),
+                "end_time": (by_ts[start_ts] + duration).isoformat(),
+            }
+            for start_ts in claimed
+        ]
+        # 呼び出し元 (切断されたHTTPリクエストなど) がキャンセルされても、応答を待って結果を記録する
+        send = asyncio.create_task(self._send(series, claimed, events))
+        self._sends.add(send)
+        send.add_done_callback(self._forget)
+        return await asyncio.shield(send)
+
+    def _forget(self, send: asyncio.Task):
+        self._sends.discard(send)
+        # 呼び出し元が先にキャンセルされていても例外を取得済みにしておく (_sendで記録済み)
+        if not send.cancelled():
+            send.exception()
+
+    async def _send(self, series: dict, claimed: list[int], events: list[dict]) -> int:
+        series_id = series["series_id"]
+        try:
+            response = await self.sender.send_async(
+                {"action": "create_events", "caller": "series", "guild_id": series["guild_id"], "events": events},
+                timeout=SERIES_CREATE_TIMEOUT
+            )
+        except ConnectorUnavailable:
+            # 送信していない回は登録を取り消して次回に作り直す
+            await SeriesDB.release_occurrences(series_id, claimed)
+            raise
+        except BaseException as e:
+            # Botが作成を続けている可能性があるため、作り直さずに結果不明として残す
+            Log.warning(f"no result for occurrences of series {series_id}: {e!r}")
+            await SeriesDB.settle_occurrences(series_id, [(start_ts, "unknown", repr(e)) for start_ts in claimed])
+            raise
+
+        message = response.get("message")
+        if response.get("status") == "busy":
+            # 実行されずに断られた
+            Log.warning(f"bot rejected occurrences of series {series_id}: {message}")
+            await SeriesDB.release_occurrences(series_id, claimed)
+            return 0
+        if response.get("status") != "ok" or not isinstance(message, dict):
+            # Bot側のタイムアウトなどでは途中まで作成されている場合がある
+            Log.warning(f"bot failed occurrences of series {series_id}: {message}")
+            await SeriesDB.settle_occurrences(series_id, [(start_ts, "unknown", str(message)) for start_ts in claimed])
+            return 0
+
+        results = {}
+        for result in message.get("results", []):
+            status = "created" if result.get("status") == "ok" else "failed"
+            results[claimed[result["index"]]] = (status, str(result.get("message")))
+        for start_ts in claimed:
+            if start_ts not in results:
+                results[start_ts] = ("unknown", "missing from the bot's results")
+        await SeriesDB.settle_occurrences(
+            series_id, [(start_ts, status, message) for start_ts, (status, message) in results.items()]
+        )
+
+        created = sum(1 for status, _ in results.values() if status == "created")
+        Log.info(f"series {series_id}: created {created}/{len(claimed)} occurrences")
+        return created
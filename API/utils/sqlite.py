@@ -0,0 +1,164 @@
+import asyncio
+import aiosqlite
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Iterable, Optional
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+DATABASE_PATH = "/Database/users.db"
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+DB_CACHED_STATEMENTS = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+)
+
+
+class SQLitePool:
+    """A fixed set of long-lived aiosqlite connections shared by the whole process.
+
+    Connections run in autocommit mode; writes are serialized in-process because
+    SQLite only allows one writer at a time, while reads run concurrently under WAL.
+    """
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._connections: list[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def opened(self) -> bool:
+        return self._idle is not None
+
+    async def open(self):
+        if self.opened:
+            return
+
+        idle: asyncio.Queue = asyncio.Queue()
+        try:
+            for _ in range(self.size):
+                conn = await aiosqlite.connect(
+                    self.path,
+                    isolation_level=None,
+                    cached_statements=DB_CACHED_STATEMENTS
+                )
+                for pragma in PRAGMAS:
+                    await conn.execute(pragma)
+                self._connections.append(conn)
+                idle.put_nowait(conn)
+        except Exception:
+            await self.close()
+            raise
+
+        self._idle = idle
+        Log.info(f"opened {self.size} connections to {self.path}")
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        self._idle = None
+        for conn in connections:
+            try:
+                await conn.close()
+            except Exception as e:
+                Log.warning(f"error while closing database connection: {e}")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._idle is None:
+            raise RuntimeError("database pool is not open")
+        idle = self._idle
+        conn = await idle.get()
+        try:
+            yield conn
+        finally:
+            idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._write_lock, self.acquire() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    async def execute(self, sql: str, params: Iterable[Any] = ()) -> int:
+        async with self._write_lock, self.acquire() as conn:
+            cursor = await conn.execute(sql, params)
+            rowcount = cursor.rowcount
+            await cursor.close()
+            return rowcount
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Iterable[Any]]) -> int:
+        async with self.transaction() as conn:
+            cursor = await conn.executemany(sql, seq_of_params)
+            rowcount = cursor.rowcount
+            await cursor.close()
+            return rowcount
+
+    async def fetchone(self, sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+        async with self.acquire() as conn:
+            cursor = await conn.execute(sql, params)
+            row = await cursor.fetchone()
+            await cursor.close()
+            return row
+
+    async def fetchall(self, sql: str, params: Iterable[Any] = ()) -> list[tuple]:
+        async with self.acquire() as conn:
+            cursor = await conn.execute(sql, params)
+            rows = await cursor.fetchall()
+            await cursor.close()
+            return list(rows)
+
+
+database = SQLitePool(DATABASE_PATH)
+
+
+class Repository:
+    """Base class for stores backed by the shared pool.
+
+    Subclasses list their CREATE statements in SCHEMA and use the helpers below.
+    """
+
+    SCHEMA: tuple[str, ...] = ()
+    pool: SQLitePool = database
+
+    @classmethod
+    async def init_schema(cls):
+        async with cls.pool.transaction() as db:
+            for statement in cls.SCHEMA:
+                await db.execute(statement)
+
+    @classmethod
+    def transaction(cls):
+        return cls.pool.transaction()
+
+    @classmethod
+    async def execute(cls, sql: str, params: Iterable[Any] = ()) -> int:
+        return await cls.pool.execute(sql, params)
+
+    @classmethod
+    async def executemany(cls, sql: str, seq_of_params: Iterable[Iterable[Any]]) -> int:
+        return await cls.pool.executemany(sql, seq_of_params)
+
+    @classmethod
+    async def fetchone(cls, sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+        return await cls.pool.fetchone(sql, params)
+
+    @classmethod
+    async def fetchall(cls, sql: str, params: Iterable[Any] = ()) -> list[tuple]:
+        return await cls.pool.fetchall(sql, params)
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from utils.logger import Logger
+from utils.sqlite import Repository
+
+Log = Logger(__name__)
+
+# 複数のワーカー・レプリカで共有する状態の保存先
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+
+
+class StateBackend(ABC):
+    """State shared by every API worker: short-lived sessions, counters and leases.
+
+    Values are JSON-serializable. Implementations must make ``pop``, ``incr`` and
+    ``acquire_lease`` atomic across processes. A networked store (Redis etc.) can be
+    plugged in by subclassing this and registering it in ``STATE_BACKENDS``.
+    """
+
+    async def init(self):
+        """起動時に一度だけ呼ばれる。"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Any:
+        """値を返す。存在しないか期限切れの場合はNone。"""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    async def pop(self, key: str) -> Any:
+        """値を取り出して削除する。同じキーを同時に取り出しても値を受け取るのは1つだけ。"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """整数値を1増やし、増やした後の値を返す。"""
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """リースを取得(または更新)できた場合にTrue。他の所有者のリースが有効な間はFalse。"""
+
+    @abstractmethod
+    async def release_lease(self, name: str, owner: str):
+        ...
+
+
+class SQLiteStateBackend(StateBackend, Repository):
+    """Shared state in the API's SQLite database; enough for several workers on one host."""
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS shared_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        """,
+    )
+
+    async def init(self):
+        await self.init_schema()
+        await self.execute("DELETE FROM shared_state WHERE expires_at <= ?", (time.time(),))
+
+    async def get(self, key: str) -> Any:
+        now = time.time()
+        row = await self.fetchone("SELECT value, expires_at FROM shared_state WHERE key = ?", (key,))
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= now:
+            # 期限切れの値は残さない (ログイン途中の情報などを含むため)
+            await self.execute("DELETE FROM shared_state WHERE key = ? AND expires_at <= ?", (key, now))
+            return None
+        return json.loads(row[0])
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        now = time.time()
+        async with self.transaction() as db:
+            # 読み出されないまま期限切れになった値も、書き込みのついでに消す
+            await db.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+            await db.execute(
+                """
+                INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                """,
+                (key, json.dumps(value), None if ttl is None else now + ttl)
+            )
+
+    async def pop(self, key: str) -> Any:
+        now = time.time()
+        async with self.transaction() as db:
+            cursor = await db.execute("DELETE FROM shared_state WHERE key = ? RETURNING value, expires_at", (key,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            await db.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0])
+
+    async def delete(self, key: str):
+        await self.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    async def incr(self, key: str) -> int:
+        async with self.transaction() as db:
+            cursor = await db.execute(
+                """
+                INSERT INTO shared_state (key, value) VALUES (?, '1')
+                ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+                RETURNING value
+                """,
+                (key,)
+            )
+            row = await cursor.fetchone()
+            await cursor.close()
+        return int(row[0])
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        return await self.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+            """,
+            (name, owner, now + ttl, now)
+        ) > 0
+
+    async def release_lease(self, name: str, owner: str):
+        await self.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+STATE_BACKENDS: dict[str, type[StateBackend]] = {
+    "sqlite": SQLiteStateBackend,
+}
+
+
+def create_state_backend(name: str = STATE_BACKEND) -> StateBackend:
+    try:
+        backend = STATE_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown STATE_BACKEND {name!r} (available: {', '.join(STATE_BACKENDS)})") from None
+    return backend()
+
+
+state_backend = create_state_backend()
@@ -7,17 +7,31 @@ from vrchatapi.api_client import ApiClient
 
 import os
 import json
+import time
+import hmac
+import base64
+import hashlib
 import asyncio
+from typing import Any, Callable, Optional
 
 from cryptography.fernet import Fernet, InvalidToken
 from http.cookiejar import Cookie
 
 from utils.logger import Logger
+from utils.auth import KEYFILE
 
 Log = Logger(__name__)
 CREDENTIAL_PATH = "/Secrets/vrc/credential.json"
+# パスワードでログインしてから2FAコードを受け付けるまでの秒数
+PENDING_LOGIN_TTL = 600
+# 使われていないログイン済みセッションを破棄するまでの秒数
+VRC_SESSION_IDLE_TTL = float(os.environ.get("VRC_SESSION_IDLE_TTL", 1800))
+USER_AGENT = "VRChatEventManager/0.1.0 haruyq@users.noreply.github.com"
 
 class Credentials: # TODO: セキュリティ実装しようね
+    # ((st_mtime_ns, st_size), 内容)。ファイルが書き換えられた場合のみ読み直す
+    _cache: Optional[tuple[tuple[int, int], dict]] = None
+
     @staticmethod
     def save_cookie(email: str, password: str, cookie_jar):
         data = {
@@ -30,21 +44,34 @@ class Credentials: # TODO: セキュリティ実装しようね
         os.makedirs("/Secrets/vrc", exist_ok=True)
         with open(CREDENTIAL_PATH, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
+        Credentials._cache = None
 
     @staticmethod
     def load_cookie():
-        if not os.path.exists(CREDENTIAL_PATH):
+        try:
+            stat = os.stat(CREDENTIAL_PATH)
+        except FileNotFoundError:
+            Credentials._cache = None
             return None
 
+        # 他のワーカーがログイン・ログアウトした場合もmtimeの変化で検出できる
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = Credentials._cache
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
         try:
             with open(CREDENTIAL_PATH, "r", encoding="utf-8") as f:
-                return json.load(f)
+                data = json.load(f)
         except Exception as exc:
             Log.error("Failed to load VRChat credentials: %s", exc)
             return None
+        Credentials._cache = (version, data)
+        return data
 
     @staticmethod
     def remove_credential():
+        Credentials._cache = None
         if os.path.exists(CREDENTIAL_PATH):
             os.remove(CREDENTIAL_PATH)
             return True
@@ -72,33 +99,37 @@ class VRChatLogin:
                     None, {})
 
     @staticmethod
-    def login_using_cookie():
-        if Credentials.logged_in():
-            data = Credentials.load_cookie()
+    def open_client(data: dict) -> ApiClient:
+        """保存済みのクッキーを設定したApiClientを作る。通信は行わない。"""
+        configuration = vrchatapi.Configuration(
+            username=data["email"],
+            password=data["password"],
+        )
+        api_client = vrchatapi.ApiClient(configuration)
+        api_client.user_agent = USER_AGENT
+        api_client.rest_client.cookie_jar.set_cookie(
+            VRChatLogin._make_cookie("auth", data["auth"]))
+        api_client.rest_client.cookie_jar.set_cookie(
+            VRChatLogin._make_cookie("twoFactorAuth", data["twoFactorAuth"]))
+        return api_client
 
-        else:
+    @staticmethod
+    def login_using_cookie():
+        data = Credentials.load_cookie()
+        if data is None:
             Log.error("No saved VRChat credentials found.")
             return None, None
         
+        # 呼び出し元で使い続けるため、withで閉じずに返す
+        api_client = VRChatLogin.open_client(data)
         try:
-            configuration = vrchatapi.Configuration(
-                username=data["email"],
-                password=data["password"],
-            )
-            with vrchatapi.ApiClient(configuration) as api_client:
-                api_client.user_agent = "VRChatEventManager/0.1.0 haruyq@users.noreply.github.com"
-                api_client.rest_client.cookie_jar.set_cookie(
-                    VRChatLogin._make_cookie("auth", data["auth"]))
-                api_client.rest_client.cookie_jar.set_cookie(
-                    VRChatLogin._make_cookie("twoFactorAuth", data["twoFactorAuth"]))
-
-                auth_api = authentication_api.AuthenticationApi(api_client)
-                current_user = auth_api.get_current_user()
-                
-                return api_client, current_user
+            auth_api = authentication_api.AuthenticationApi(api_client)
+            current_user = auth_api.get_current_user()
+            return api_client, current_user
             
         except vrchatapi.ApiException as e:
             Log.error("Exception when calling API: %s\n", e)
+            api_client.close()
             return None, None
 
     def login(self):
@@ -119,7 +150,7 @@ class VRChatLogin:
             password = self.password,
         )
         with vrchatapi.ApiClient(configuration) as api_client:
-            api_client.user_agent = "VRChatEventManager/0.1.0 haruyq@users.noreply.github.com"
+            api_client.user_agent = USER_AGENT
 
             auth_api = authentication_api.AuthenticationApi(api_client)
 
@@ -145,6 +176,54 @@ class VRChatLogin:
 
             return api_client, current_user
 
+    @staticmethod
+    def auth_cookie(api_client: ApiClient) -> str | None:
+        """ApiClientが持つauthクッキーを返す。2FA待ちのログインを別のワーカーで続ける場合などに使う。"""
+        cookies = api_client.rest_client.cookie_jar._cookies.get("api.vrchat.cloud", {}).get("/", {})
+        auth = cookies.get("auth")
+        return auth.value if auth is not None else None
+
+    @staticmethod
+    def _pending_cipher() -> Fernet:
+        # 署名鍵は全ワーカーで共通で、共有の状態 (users.db) とは別のボリュームにある
+        with open(KEYFILE, "rb") as f:
+            digest = hashlib.sha256(b"vrc-pending-login:" + f.read()).digest()
+        return Fernet(base64.urlsafe_b64encode(digest))
+
+    def pending(self, api_client: ApiClient) -> dict:
+        """2FA待ちのログインを別のワーカーで続けるための情報。パスワードは暗号化して含める。"""
+        sealed = VRChatLogin._pending_cipher().encrypt(self.password.encode("utf-8"))
+        return {
+            "email": self.email,
+            "sealed_password": sealed.decode("ascii"),
+            "auth": VRChatLogin.auth_cookie(api_client),
+        }
+
+    @staticmethod
+    def from_pending(pending: dict) -> tuple["VRChatLogin", ApiClient] | None:
+        """pendingの情報からログインを再開する。期限切れや復号できない場合はNoneを返す。"""
+        if not pending.get("auth"):
+            return None
+        try:
+            password = VRChatLogin._pending_cipher().decrypt(
+                pending["sealed_password"].encode("ascii"), ttl=PENDING_LOGIN_TTL
+            ).decode("utf-8")
+        except (KeyError, InvalidToken):
+            return None
+        vrchat_login = VRChatLogin(pending["email"], password)
+        return vrchat_login, vrchat_login.resume(pending["auth"])
+
+    def resume(self, auth: str) -> ApiClient:
+        """auth_cookieのクッキーから2FA待ちのApiClientを作り直す。"""
+        configuration = vrchatapi.Configuration(
+            username = self.email,
+            password = self.password,
+        )
+        api_client = vrchatapi.ApiClient(configuration)
+        api_client.user_agent = USER_AGENT
+        api_client.rest_client.cookie_jar.set_cookie(VRChatLogin._make_cookie("auth", auth))
+        return api_client
+
     def twofa(self, api_client: ApiClient, code: str, type: str):
         auth_api = authentication_api.AuthenticationApi(api_client)
         
@@ -183,4 +262,172 @@ class VRChatLogin:
     
     async def logout_async(self):
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, self.logout)
\ No newline at end of file
+        return await loop.run_in_executor(None, self.logout)
+
+class VRChatNotLoggedIn(Exception):
+    """No usable VRChat login is saved; the account has to log in again from the dashboard."""
+
+
+class VRChatSession:
+    def __init__(self, email: str, auth: str, api_client: ApiClient):
+        self.email = email
+        # 作成に使ったauthクッキー。保存済みの資格情報と異なれば作り直す
+        self.auth = auth
+        self.api_client = api_client
+        # 1つのApiClient(クッキー)を同時に使わないようにする
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.api_client.close()
+
+
+class VRChatSessionManager:
+    """Keeps one authenticated ApiClient per VRChat account warm between requests.
+
+    Sessions are built from the saved cookies without a round trip and are only
+    re-authenticated when VRChat rejects them. Idle ones are closed after ``idle_ttl``.
+    Calls on the same account are serialized, since they share a cookie jar.
+    """
+
+    def __init__(self, idle_ttl: float = VRC_SESSION_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._sessions: dict[str, VRChatSession] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.opened = 0
+        self.reauths = 0
+        self.evictions = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.invalidate()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(60.0, self.idle_ttl / 2))
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for email, session in list(self._sessions.items()):
+            if now - session.last_used > self.idle_ttl and not session.lock.locked():
+                self._drop(email)
+                self.evictions += 1
+
+    def _drop(self, email: str):
+        session = self._sessions.pop(email, None)
+        if session is not None:
+            session.close()
+
+    def invalidate(self, email: Optional[str] = None):
+        """セッションを破棄する。emailを省略した場合は全て破棄する。"""
+        for key in [email] if email is not None else list(self._sessions):
+            self._drop(key)
+
+    def adopt(self, email: str, api_client: ApiClient):
+        """ログイン・2FA直後のApiClientをそのままセッションとして使う。"""
+        auth = VRChatLogin.auth_cookie(api_client)
+        if auth is None:
+            api_client.close()
+            return
+        self._drop(email)
+        self._sessions[email] = VRChatSession(email, auth, api_client)
+
+    async def session(self, email: Optional[str] = None) -> VRChatSession:
+        data = Credentials.load_cookie()
+        if data is None or (email is not None and data["email"] != email):
+            raise VRChatNotLoggedIn("VRChat account is not logged in")
+
+        email = data["email"]
+        async with self._locks.setdefault(email, asyncio.Lock()):
+            session = self._sessions.get(email)
+            if session is not None and session.auth == data["auth"]:
+                self.hits += 1
+                session.last_used = time.monotonic()
+                return session
+
+            # 未作成、または他のワーカーが再ログインして資格情報が変わった
+            self._drop(email)
+            session = VRChatSession(email, data["auth"], VRChatLogin.open_client(data))
+            self._sessions[email] = session
+            self.opened += 1
+            return session
+
+    async def call(self, func: Callable[[ApiClient], Any], email: Optional[str] = None) -> Any:
+        """ログイン済みのApiClientで ``func`` をスレッドプール上で実行する。
+
+        認証が切れていた場合は保存済みのパスワードで1度だけ再ログインしてから再実行する。
+        """
+        session = await self.session(email)
+        loop = asyncio.get_running_loop()
+        async with session.lock:
+            session.last_used = time.monotonic()
+            try:
+                return await loop.run_in_executor(None, func, session.api_client)
+            except UnauthorizedException as e:
+                if e.status != 401:
+                    raise
+            self.reauths += 1
+            Log.info(f"VRChat session for {session.email} expired, logging in again")
+            try:
+                await loop.run_in_executor(None, self._reauth, session)
+            except vrchatapi.ApiException as e:
+                self._drop(session.email)
+                raise VRChatNotLoggedIn(f"VRChat re-login failed: {e}") from e
+            return await loop.run_in_executor(None, func, session.api_client)
+
+    @staticmethod
+    def _reauth(session: VRChatSession):
+        cookie_jar = session.api_client.rest_client.cookie_jar
+        try:
+            cookie_jar.clear("api.vrchat.cloud", "/", "auth")
+        except KeyError:
+            pass
+        # authクッキーがなければConfigurationのパスワードで認証される (twoFactorAuthクッキーが有効なら2FAは不要)
+        authentication_api.AuthenticationApi(session.api_client).get_current_user()
+
+        cookies = cookie_jar._cookies["api.vrchat.cloud"]["/"]
+        Credentials.save_cookie(session.email, session.api_client.configuration.password, cookies)
+        session.auth = cookies["auth"].value
+
+    async def current_user(self, email: Optional[str] = None) -> vrchatapi.CurrentUser:
+        return await self.call(lambda api_client: authentication_api.AuthenticationApi(api_client).get_current_user(), email)
+
+    async def logged_in_user(self, email: str, password: str) -> vrchatapi.CurrentUser | None:
+        """保存済みのログインと同じアカウント・パスワードなら、セッションを使い回して現在のユーザーを返す。
+
+        ログインし直す必要がある場合はNoneを返す。
+        """
+        data = Credentials.load_cookie()
+        if (
+            data is None
+            or data.get("email") != email
+            or not hmac.compare_digest(str(data.get("password")).encode("utf-8"), password.encode("utf-8"))
+        ):
+            return None
+        try:
+            return await self.current_user(email)
+        except (VRChatNotLoggedIn, vrchatapi.ApiException) as e:
+            Log.info(f"saved VRChat login for {email} is no longer usable: {e}")
+            return None
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "opened": self.opened,
+            "reauths": self.reauths,
+            "evictions": self.evictions,
+        }
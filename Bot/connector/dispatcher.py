@@ -0,0 +1,211 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from connector.idempotency import IdempotencyStore
+from connector.responses import Responses
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+Handler = Callable[[dict], Awaitable[dict]]
+
+
+class Lane:
+    HIGH = "high"         # 認証まわり: 他の処理の後ろに並ばない
+    NORMAL = "normal"
+    MUTATING = "mutating" # Discord上に変更を加える重い処理
+
+
+# レーンごとの同時実行数。HIGHは実質無制限にして、重い処理が詰まっていても待たせない
+LANE_CONCURRENCY = {
+    Lane.HIGH: 256,
+    Lane.NORMAL: 16,
+    Lane.MUTATING: 4,
+}
+
+
+@dataclass
+class ActionStats:
+    queued: int = 0
+    running: int = 0
+    completed: int = 0
+    rejected: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    deduplicated: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    service_total: float = 0.0
+    service_max: float = 0.0
+
+    def snapshot(self) -> dict:
+        finished = self.completed + self.timeouts + self.errors
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "deduplicated": self.deduplicated,
+            "wait_avg_ms": round(self.wait_total / finished * 1000, 3) if finished else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "service_avg_ms": round(self.service_total / finished * 1000, 3) if finished else 0.0,
+            "service_max_ms": round(self.service_max * 1000, 3),
+        }
+
+
+@dataclass
+class ActionSpec:
+    name: str
+    func: Handler
+    lane: str = Lane.NORMAL
+    max_concurrency: int = 8
+    timeout: Optional[float] = 30.0
+    queue_depth: int = 64
+    idempotent: bool = False
+    stats: ActionStats = field(default_factory=ActionStats)
+
+    def __post_init__(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+
+class Dispatcher:
+    """Routes connector requests to registered actions.
+
+    Every action has its own concurrency limit, timeout and bounded wait queue,
+    and additionally runs inside the lane it was registered with.
+
+    For idempotent actions, a request that repeats an ``idempotency_key`` is answered
+    with the result of the first request (waiting for it if it is still running)
+    instead of running the action again. Keys are kept in ``store`` so this survives a
+    restart of this bot, but not a retry that reaches a different bot instance.
+    """
+
+    def __init__(self, lane_concurrency: Optional[dict[str, int]] = None, store: Optional[IdempotencyStore] = None):
+        self.lanes = {
+            name: asyncio.Semaphore(limit)
+            for name, limit in (lane_concurrency or LANE_CONCURRENCY).items()
+        }
+        self.actions: dict[str, ActionSpec] = {}
+        self.store = store
+        # (action, idempotency_key) -> 実行中の処理
+        self._inflight: dict[tuple[str, str], asyncio.Task] = {}
+
+    def register(self, name: str, func: Handler, *, lane: str = Lane.NORMAL, max_concurrency: int = 8,
+                 timeout: Optional[float] = 30.0, queue_depth: int = 64, idempotent: bool = False):
+        if lane not in self.lanes:
+            raise ValueError(f"unknown lane: {lane}")
+        self.actions[name] = ActionSpec(name, func, lane, max_concurrency, timeout, queue_depth, idempotent)
+
+    async def dispatch(self, data: dict) -> dict:
+        action = data.get("action")
+        spec = self.actions.get(action)
+        if spec is None:
+            return Responses.error("Unknown action")
+
+        idempotency_key = data.get("idempotency_key")
+        if not spec.idempotent or not idempotency_key:
+            return await self._run(spec, data)
+
+        key = (action, str(idempotency_key))
+        task = self._inflight.get(key)
+        if task is not None:
+            spec.stats.deduplicated += 1
+            Log.info(f"{action} {idempotency_key} is already running, waiting for its result")
+        else:
+            # 接続が切れても処理を続け、再送されたリクエストに結果を返す
+            task = asyncio.create_task(self._run_once(spec, data, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: tuple[str, str], task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 待っている呼び出しがない場合に未取得の例外として警告されないようにする
+        if not task.cancelled():
+            task.exception()
+
+    async def _run_once(self, spec: ActionSpec, data: dict, key: tuple[str, str]) -> dict:
+        previous = await self.store.begin(*key) if self.store is not None else None
+        if previous is not None:
+            spec.stats.deduplicated += 1
+            Log.info(f"{key[0]} {key[1]} was already received, answering with its result")
+            return previous
+
+        try:
+            response = await self._run(spec, data)
+        except asyncio.CancelledError:
+            # 停止などで打ち切られた。反映されたか分からないため、記録を残して再送にはunknownを返す
+            raise
+        except Exception:
+            await self._discard(key)
+            raise
+
+        # 実行されなかった(busy)ものは再送時にやり直す。反映されたか分からないもの(unknown)はやり直さない
+        if response is None or response.get("status") == "busy":
+            await self._discard(key)
+        elif self.store is not None:
+            await self.store.finish(*key, response)
+        return response
+
+    async def _discard(self, key: tuple[str, str]):
+        if self.store is not None:
+            await self.store.forget(*key)
+
+    async def _run(self, spec: ActionSpec, data: dict) -> dict:
+        action = spec.name
+        stats = spec.stats
+        if stats.queued >= spec.queue_depth:
+            stats.rejected += 1
+            Log.warning(f"rejecting {action}: {stats.queued} requests already queued")
+            return Responses.busy(f"Too many pending {action} requests")
+
+        queued_at = time.perf_counter()
+        stats.queued += 1
+        try:
+            await spec.semaphore.acquire()
+            try:
+                await self.lanes[spec.lane].acquire()
+            except BaseException:
+                spec.semaphore.release()
+                raise
+        finally:
+            stats.queued -= 1
+
+        started_at = time.perf_counter()
+        wait = started_at - queued_at
+        stats.wait_total += wait
+        stats.wait_max = max(stats.wait_max, wait)
+        stats.running += 1
+        try:
+            response = await asyncio.wait_for(spec.func(data), spec.timeout)
+            stats.completed += 1
+            return response
+        except asyncio.TimeoutError:
+            stats.timeouts += 1
+            Log.error(f"{action} timed out after {spec.timeout}s")
+            # 打ち切る前にDiscordへのリクエストが反映されている場合があるため、失敗とは区別する
+            return Responses.unknown(f"{action} timed out and may have been applied")
+        except (TypeError, ValueError) as e:
+            stats.errors += 1
+            return Responses.error(f"Invalid request: {e}")
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            service = time.perf_counter() - started_at
+            stats.service_total += service
+            stats.service_max = max(stats.service_max, service)
+            stats.running -= 1
+            self.lanes[spec.lane].release()
+            spec.semaphore.release()
+
+    def snapshot(self) -> dict:
+        return {
+            name: {"lane": spec.lane, **spec.stats.snapshot()}
+            for name, spec in self.actions.items()
+        }
@@ -1,6 +1,5 @@
-import json
-import aiohttp
-
+import asyncio
+import os
 from datetime import datetime, timedelta
 from dateutil import tz
 
@@ -8,13 +7,32 @@ import discord
 from discord.ext import commands
 
 from utils.logger import Logger
+from utils.image_cache import ImageFetchError
+from utils.image_processing import ImageProcessingError
+from utils.admin_index import is_admin
+from connector.dispatcher import Dispatcher, Lane
 from connector.responses import Responses
+from connector.upload import Upload, UploadError
 
 Log = Logger(__name__)
 
+BULK_CREATE_CONCURRENCY = int(os.environ.get("BULK_CREATE_CONCURRENCY", 4))
+BULK_CREATE_MAX_EVENTS = int(os.environ.get("BULK_CREATE_MAX_EVENTS", 100))
+
 class RequestHandler:
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self.dispatcher = Dispatcher(store=bot.idempotency)
+        self.dispatcher.register("ping", self.ping, lane=Lane.HIGH, max_concurrency=256, timeout=5)
+        self.dispatcher.register("stats", self.stats, lane=Lane.HIGH, max_concurrency=4, timeout=5)
+        self.dispatcher.register("check_admin", self.check_admin, lane=Lane.HIGH, max_concurrency=64, timeout=10)
+        # APIのジョブは再送されることがあるため、idempotency_keyで二重に実行しない (このBotが受け付けたものに限る)
+        self.dispatcher.register("send_announcement", self.send_announcement, lane=Lane.MUTATING,
+                                 max_concurrency=2, timeout=30, queue_depth=8, idempotent=True)
+        self.dispatcher.register("create_event", self.create_event, lane=Lane.MUTATING,
+                                 max_concurrency=2, timeout=60, queue_depth=8, idempotent=True)
+        self.dispatcher.register("create_events", self.create_events, lane=Lane.MUTATING,
+                                 max_concurrency=1, timeout=900, queue_depth=2)
 
     def parse_entity_type(self, entity_type_str: str) -> discord.EntityType:
         match entity_type_str.lower():
@@ -50,133 +68,205 @@ class RequestHandler:
 
         return start_time, end_time, result
 
-    async def handle(self, message): # Received JSON Handler
+    async def handle(self, data: dict): # Received JSON Handler
+        Log.debug(f"Handling Data:\n {data}")
+        return await self.dispatcher.dispatch(data)
+
+    async def ping(self, data: dict):
+        return Responses.ok("pong")
+
+    async def stats(self, data: dict):
+        return Responses.ok({
+            "actions": self.dispatcher.snapshot(),
+            "http": self.bot.http_client.stats(),
+            "image_cache": self.bot.image_cache.stats(),
+            "image_processor": self.bot.image_processor.stats(),
+            "outbound": self.bot.outbound.stats(),
+            "admin_index": self.bot.admin_index.stats() if self.bot.admin_index is not None else None
+        })
+
+    async def send_announcement(self, data: dict):
+        channel_id = data.get("channel_id")
+        everyone = data.get("everyone", False)
+        message = data.get("message")
+
+        if channel_id is None:
+            return Responses.error("channel_id is required")
+
+        channel = self.bot.get_channel(int(channel_id))
+        if channel is None:
+            channel = await self.bot.fetch_channel(int(channel_id))
+
+        if everyone:
+            allowed_mentions = discord.AllowedMentions(everyone=True)
+            message = f"@everyone\n {message}"
+        else:
+            allowed_mentions = discord.AllowedMentions.none()
+
+        msg = await self.bot.outbound.submit(
+            "send_message",
+            lambda: channel.send(message, allowed_mentions=allowed_mentions),
+            caller=data.get("caller"),
+            channel_id=channel.id
+        )
+        return Responses.ok(f"Announcement sent with ID {msg.id}")
+
+    async def create_event(self, data: dict):
+        guild_id = int(data.get("guild_id"))
+        channel_id = data.get("channel_id", None)
+        name = data.get("name")
+        description = data.get("description")
+        start_time = data.get("start_time", None)
+        end_time = data.get("end_time", None)
+        entity_type = self.parse_entity_type(data.get("entity_type"))
+        location = data.get("location")
+        image_uri = data.get("image_uri", None)
+        attachment = data.get("attachment", None)
+
+        # if entity_type is not external, it must be set a channel
+        # and location must be MISSING
+        if channel_id is not None and entity_type in (
+            discord.EntityType.stage_instance,
+            discord.EntityType.voice
+        ):
+            channel = self.bot.get_channel(int(channel_id))
+            if channel is None:
+                channel = await self.bot.fetch_channel(int(channel_id))
+                location = discord.utils.MISSING
+
+            if not channel or not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)):
+                return Responses.error("Invalid channel for the specified entity type")
+        elif channel_id is None and entity_type in (discord.EntityType.stage_instance, discord.EntityType.voice):
+            return Responses.error("channel_id is required for the specified entity type")
+        else:
+            channel = discord.utils.MISSING
+
+        # Use the uploaded image, or download it (or read it from the local cache) if provided
+        if isinstance(attachment, Upload):
+            try:
+                image_bytes = await attachment.read()
+            except UploadError as e:
+                return Responses.error(str(e))
+        elif image_uri is not None:
+            try:
+                image_bytes = await self.bot.image_cache.fetch(image_uri)
+            except ImageFetchError as e:
+                return Responses.error(str(e))
+        else:
+            image_bytes = discord.utils.MISSING
+
+        # Resize and recompress to the cover size off the event loop
+        if image_bytes is not discord.utils.MISSING:
+            try:
+                image_bytes = await self.bot.image_processor.process(image_bytes)
+            except ImageProcessingError as e:
+                return Responses.error(str(e))
+
         try:
-            data: dict = json.loads(message)
-            Log.debug(f"Handling Data:\n {data}")
-            action = data.get("action")
-            
-            match action:
-                case "ping":
-                    return Responses.ok("pong")
-
-                case "send_announcement":
-                    channel_id = data.get("channel_id")
-                    everyone = data.get("everyone", False)
-                    message = data.get("message")
-
-                    if channel_id is None:
-                        return Responses.error("channel_id is required")
-
-                    channel = self.bot.get_channel(int(channel_id))
-                    if channel is None:
-                        channel = await self.bot.fetch_channel(int(channel_id))
-
-                    if everyone:
-                        allowed_mentions = discord.AllowedMentions(everyone=True)
-                        message = f"@everyone\n {message}"
-                    else:
-                        allowed_mentions = discord.AllowedMentions.none()
-
-                    msg = await channel.send(message, allowed_mentions=allowed_mentions)
-                    return Responses.ok(f"Announcement sent with ID {msg.id}")
-                
-                case "create_event":
-                    guild_id = int(data.get("guild_id"))
-                    channel_id = data.get("channel_id", None)
-                    name = data.get("name")
-                    description = data.get("description")
-                    start_time = data.get("start_time", None)
-                    end_time = data.get("end_time", None)
-                    entity_type = self.parse_entity_type(data.get("entity_type"))
-                    location = data.get("location")
-                    image_uri = data.get("image_uri", None)
-                    
-                    # if entity_type is not external, it must be set a channel
-                    # and location must be MISSING
-                    if channel_id is not None and entity_type in (
-                        discord.EntityType.stage_instance,
-                        discord.EntityType.voice
-                    ):
-                        channel = self.bot.get_channel(int(channel_id))
-                        if channel is None:
-                            channel = await self.bot.fetch_channel(int(channel_id))
-                            location = discord.utils.MISSING
-                        
-                        if not channel or not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)):
-                            return Responses.error("Invalid channel for the specified entity type")
-                    elif channel_id is None and entity_type in (discord.EntityType.stage_instance, discord.EntityType.voice):
-                        return Responses.error("channel_id is required for the specified entity type")
-                    else:
-                        channel = discord.utils.MISSING
-                    
-                    # Download image and encode to bytes if provided
-                    if image_uri is not None:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(image_uri) as resp:
-                                if resp.status != 200:
-                                    return Responses.error("Failed to fetch image from URI")
-                                image_bytes = await resp.read()
-                    else:
-                        image_bytes = discord.utils.MISSING
-                    
-                    try:
-                        guild = self.bot.get_guild(guild_id)
-                        if guild is None:
-                            guild = await self.bot.fetch_guild(guild_id)
-                        
-                        if not guild:
-                            return Responses.error("Guild not found")
-                        
-                        start_time, end_time, result = self.parse_isotime(start_time, end_time)
-                        if not result:
-                            return Responses.error("Invalid start_time; must be in the future")
-                        
-                        kwargs = {
-                            "name": name,
-                            "start_time": start_time,
-                            "end_time": end_time,
-                            "entity_type": entity_type,
-                            "privacy_level": discord.PrivacyLevel.guild_only,
-                            "description": description,
-                            "image": image_bytes,
-                            "reason": "Created via VRCEventManager",
-                        }
-                        if entity_type in (discord.EntityType.stage_instance, discord.EntityType.voice):
-                            kwargs["channel"] = channel
-                        else:
-                            kwargs["location"] = location
-
-                        event = await guild.create_scheduled_event(**kwargs)
-                        return Responses.ok(f"Event {name} created with ID {event.id}")
-                    
-                    except Exception as e:
-                        Log.error(f"Failed to create event: {e}", exc_info=True)
-                        return Responses.error(f"Failed to create event: {e}")
-
-                case "check_admin":
-                    user_id = int(data.get("user_id"))
-                    guild_id = int(data.get("guild_id"))
-                    
-                    guild = self.bot.get_guild(guild_id)
-                    if guild is None:
-                        guild = await self.bot.fetch_guild(guild_id)
-                    
-                    if not guild:
-                        return Responses.error("Guild not found")
-                    
-                    member = guild.get_member(user_id)
-                    if member is None:
-                        member = await guild.fetch_member(user_id)
-                    
-                    if not member:
-                        return Responses.error("Member not found")
-                    
-                    is_admin = any(role.permissions.administrator for role in member.roles)
-                    return Responses.ok({"is_admin": is_admin})
-
-                case _:
-                    return Responses.error("Unknown action")
-
-        except json.JSONDecodeError:
-            return Responses.error("Invalid JSON")
\ No newline at end of file
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                guild = await self.bot.fetch_guild(guild_id)
+
+            if not guild:
+                return Responses.error("Guild not found")
+
+            start_time, end_time, result = self.parse_isotime(start_time, end_time)
+            if not result:
+                return Responses.error("Invalid start_time; must be in the future")
+
+            kwargs = {
+                "name": name,
+                "start_time": start_time,
+                "end_time": end_time,
+                "entity_type": entity_type,
+                "privacy_level": discord.PrivacyLevel.guild_only,
+                "description": description,
+                "image": image_bytes,
+                "reason": "Created via VRCEventManager",
+            }
+            if entity_type in (discord.EntityType.stage_instance, discord.EntityType.voice):
+                kwargs["channel"] = channel
+            else:
+                kwargs["location"] = location
+
+            event = await self.bot.outbound.submit(
+                "create_event",
+                lambda: guild.create_scheduled_event(**kwargs),
+                caller=data.get("caller"),
+                guild_id=guild.id
+            )
+            return Responses.ok(f"Event {name} created with ID {event.id}")
+
+        except Exception as e:
+            Log.error(f"Failed to create event: {e}", exc_info=True)
+            return Responses.error(f"Failed to create event: {e}")
+
+    async def create_events(self, data: dict):
+        """Creates several events concurrently and reports a result for each of them.
+
+        discord.py already waits out 429s per route bucket, so the semaphore only keeps us from
+        piling requests onto that bucket. With ``stream`` set, each result is emitted as soon as
+        it is ready and the final response only carries the totals.
+        """
+        events = data.get("events")
+        emit = data.get("stream")
+        if not isinstance(events, list) or not events:
+            return Responses.error("events must be a non-empty list")
+        if len(events) > BULK_CREATE_MAX_EVENTS:
+            return Responses.error(f"Too many events (max {BULK_CREATE_MAX_EVENTS})")
+
+        semaphore = asyncio.Semaphore(BULK_CREATE_CONCURRENCY)
+
+        async def create(index: int, event: dict) -> dict:
+            async with semaphore:
+                try:
+                    if not isinstance(event, dict):
+                        raise TypeError("event must be an object")
+                    response = await self.create_event({**event, "caller": data.get("caller")})
+                except (TypeError, ValueError) as e:
+                    response = Responses.error(f"Invalid request: {e}")
+                except Exception as e:
+                    Log.error(f"Failed to create event #{index}: {e}", exc_info=True)
+                    response = Responses.error(f"Failed to create event: {e}")
+
+            result = {"index": index, **response}
+            if callable(emit):
+                await emit(result)
+            return result
+
+        results = await asyncio.gather(*(create(index, event) for index, event in enumerate(events)))
+        created = sum(1 for result in results if result["status"] == "ok")
+        summary = {"created": created, "failed": len(results) - created}
+        if not callable(emit):
+            summary["results"] = list(results)
+        return Responses.ok(summary)
+
+    async def check_admin(self, data: dict):
+        user_id = int(data.get("user_id"))
+        guild_id = int(data.get("guild_id"))
+
+        # メンバーインデックスが有効ならDiscordに問い合わせずに答える
+        if self.bot.admin_index is not None:
+            indexed = self.bot.admin_index.lookup(guild_id, user_id)
+            if indexed is not None:
+                return Responses.ok({"is_admin": indexed})
+
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            guild = await self.bot.fetch_guild(guild_id)
+
+        if not guild:
+            return Responses.error("Guild not found")
+
+        member = guild.get_member(user_id)
+        if member is None:
+            try:
+                member = await self.bot.outbound.fetch_member(guild, user_id, caller=data.get("caller"))
+            except discord.NotFound:
+                # サーバーに所属していないユーザーは管理者ではない (API側で否定キャッシュされる)
+                return Responses.ok({"is_admin": False})
+
+        if not member:
+            return Responses.error("Member not found")
+
+        return Responses.ok({"is_admin": is_admin(member)})
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from connector.responses import Responses
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+IDEMPOTENCY_DB = os.environ.get("IDEMPOTENCY_DB", "/Cache/idempotency.db")
+# 同じidempotency_keyのリクエストを同じ結果で答える秒数
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 3600))
+
+
+class IdempotencyStore:
+    """Remembers the idempotent requests this bot has started, and their results, on disk.
+
+    A key is recorded before the action runs, so a request that was cut off by a restart
+    is answered with ``unknown`` instead of being run again. Keys are local to this bot
+    process's cache volume; another bot instance does not see them.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            action TEXT NOT NULL,
+            key TEXT NOT NULL,
+            response TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (action, key)
+        );
+    """
+
+    def __init__(self, path: str = IDEMPOTENCY_DB, ttl: float = IDEMPOTENCY_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._db: Optional[sqlite3.Connection] = None
+        # 接続は1つなので、スレッドプール上で同時に使わないようにする
+        self._lock = asyncio.Lock()
+
+    async def open(self):
+        try:
+            await self._call(self._open)
+        except (OSError, sqlite3.Error) as e:
+            # 記録できなくてもリクエストは受け付ける (プロセス内の重複だけを防ぐ)
+            Log.error(f"failed to open idempotency store at {self.path}: {e}")
+            self._db = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute(self.SCHEMA)
+        db.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (time.time(),))
+        self._db = db
+
+    async def close(self):
+        db, self._db = self._db, None
+        if db is not None:
+            await self._call(db.close)
+
+    async def _call(self, func, *args):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def begin(self, action: str, key: str) -> dict | None:
+        """キーを記録する。初めてのキーならNone、既に受け付けたキーならその結果を返す。"""
+        if self._db is None:
+            return None
+        return await self._call(self._begin, action, key)
+
+    def _begin(self, action: str, key: str) -> dict | None:
+        now = time.time()
+        self._db.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (action, key, expires_at) VALUES (?, ?, ?)",
+            (action, key, now + self.ttl)
+        )
+        if cursor.rowcount:
+            return None
+
+        row = self._db.execute(
+            "SELECT response FROM idempotency_keys WHERE action = ? AND key = ?", (action, key)
+        ).fetchone()
+        if row is None or row[0] is None:
+            # 処理中にBotが停止した
+            return Responses.unknown(f"{action} was interrupted and may have been applied")
+        return json.loads(row[0])
+
+    async def finish(self, action: str, key: str, response: dict):
+        if self._db is not None:
+            await self._call(
+                self._execute,
+                "UPDATE idempotency_keys SET response = ? WHERE action = ? AND key = ?",
+                (json.dumps(response, default=str), action, key)
+            )
+
+    async def forget(self, action: str, key: str):
+        """実行されなかったリクエストのキーを消し、再送時にやり直せるようにする。"""
+        if self._db is not None:
+            await self._call(
+                self._execute, "DELETE FROM idempotency_keys WHERE action = ? AND key = ?", (action, key)
+            )
+
+    def _execute(self, sql: str, params: tuple):
+        self._db.execute(sql, params)
@@ -1,21 +1,73 @@
 import asyncio
-import json
+import os
 from contextlib import suppress
 from typing import Optional
 from discord.ext import commands
 
 from connector.handler import RequestHandler
+from connector.protocol import (
+	Kind, Flags, Frame, FrameReader, FrameTooLarge, check_hello, hello, write_json, MAX_FRAME_SIZE
+)
 from connector.responses import Responses
+from connector.upload import Upload
+from utils.image_cache import IMAGE_MAX_BYTES
 from utils.logger import Logger
 
 Log = Logger(__name__)
 
+HANDSHAKE_TIMEOUT = 10.0
+# PUSHで配信するトピック。membersはメンバーインテントがない場合は届かないため購読できない
+TOPICS = ("members", "roles", "scheduled_events")
+MAX_PENDING_UPLOADS = int(os.environ.get("RECEIVER_MAX_UPLOADS", 4))
+
+class Connection:
+	def __init__(self, writer: asyncio.StreamWriter, max_concurrency: int):
+		self.writer = writer
+		self.address = writer.get_extra_info("peername")
+		self.peer_max_frame_size = MAX_FRAME_SIZE
+		self.limit = asyncio.Semaphore(max_concurrency)
+		self.tasks: set[asyncio.Task] = set()
+		self.uploads: dict[int, Upload] = {}
+		self.topics: set[str] = set()
+		self.sequence = 0
+		self._write_lock = asyncio.Lock()
+
+	async def send(self, kind: int, message: dict, stream_id: int = 0, flags: int = 0):
+		async with self._write_lock:
+			try:
+				write_json(self.writer, kind, message, stream_id, flags, max_frame_size=self.peer_max_frame_size)
+			except FrameTooLarge as exc:
+				Log.error(f"response too large: {exc}")
+				write_json(self.writer, kind, Responses.error("Response too large"), stream_id, flags)
+			await self.writer.drain()
+
+	async def push(self, topic: str, event: dict):
+		async with self._write_lock:
+			# 番号は書き込む順に振る (API側で取りこぼしを検出するため)
+			self.sequence += 1
+			write_json(self.writer, Kind.PUSH, {**event, "topic": topic, "seq": self.sequence},
+				max_frame_size=self.peer_max_frame_size)
+			await self.writer.drain()
+
+	def emitter(self, stream_id: int):
+		"""ストリーミング応答の途中結果をPARTIALフレームで送る関数を返す。"""
+		async def emit(message: dict):
+			try:
+				await self.send(Kind.RESPONSE, message, stream_id, Flags.PARTIAL)
+			except ConnectionError as exc:
+				# 接続が切れても処理自体は最後まで続ける
+				Log.warning(f"could not deliver partial response to {self.address}: {exc}")
+		return emit
+
 class Receiver:
-	def __init__(self, ip: str, port: int, bot: commands.Bot):
+	def __init__(self, ip: str, port: int, bot: commands.Bot, max_concurrency: int = 32):
 		self.ip = ip
 		self.port = port
+		self.max_concurrency = max_concurrency
 		self.server: Optional[asyncio.AbstractServer] = None
 		self._serve_task: Optional[asyncio.Task] = None
+		self.connections: set[Connection] = set()
+		self.bot = bot
 		self.handler = RequestHandler(bot)
 
 	async def start(self):
@@ -38,35 +90,143 @@ class Receiver:
 			self._serve_task = None
 		Log.info("receiver stopped")
 
+	def shards(self) -> dict:
+		# 複数のBotを起動している場合に、API側がどのBotがどのサーバーを担当しているか判断するために使う
+		shard_ids = self.bot.shard_ids
+		return {
+			"shard_ids": list(shard_ids) if shard_ids is not None else None,
+			"shard_count": self.bot.shard_count
+		}
+
+	def available_topics(self) -> set[str]:
+		topics = set(TOPICS)
+		if not self.bot.intents.members:
+			topics.discard("members")
+		return topics
+
+	def _subscribe(self, conn: Connection, data: dict) -> dict:
+		requested = data.get("topics")
+		if not isinstance(requested, list):
+			return Responses.error("topics must be a list")
+		conn.topics = set(requested) & self.available_topics()
+		Log.info(f"receiver: {conn.address} subscribed to {sorted(conn.topics)}")
+		return Responses.ok({"topics": sorted(conn.topics)})
+
+	async def publish(self, topic: str, event: dict):
+		"""トピックを購読しているAPIへ通知(PUSHフレーム)を送る。"""
+		targets = [conn for conn in self.connections if topic in conn.topics]
+		if not targets:
+			return
+		Log.debug(f"push -> {topic}: {event}")
+		results = await asyncio.gather(
+			*(conn.push(topic, event) for conn in targets),
+			return_exceptions=True
+		)
+		for result in results:
+			if isinstance(result, Exception):
+				Log.warning(f"failed to push event: {result}")
+
 	async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-		address = writer.get_extra_info("peername")
-		Log.info(f"receiver: {address}")
-		while True:
-			data = await reader.read(4096)
-			if not data:
-				response = Responses.error("No data received")
-				payload = json.dumps(response).encode("utf-8")
-				writer.write(payload)
-				await writer.drain()
-				Log.debug(f"sent -> response: {response}")
+		conn = Connection(writer, self.max_concurrency)
+		Log.info(f"receiver: {conn.address}")
+		frames = FrameReader(reader)
+		try:
+			peer = check_hello(await asyncio.wait_for(frames.read_frame(), HANDSHAKE_TIMEOUT))
+			await conn.send(Kind.HELLO, hello("bot", **self.shards()))
+			conn.peer_max_frame_size = int(peer.get("max_frame_size", MAX_FRAME_SIZE))
+			Log.debug(f"handshake complete: {peer}")
+			self.connections.add(conn)
 
-			try:
-				message = data.decode()
-				Log.debug(f"received -> message: {message}")
-				if not message or message is None:
-					response = Responses.error("Empty message received")
+			while True:
+				frame = await frames.read_frame()
+				if frame is None:
+					break
+				if frame.kind == Kind.BLOB:
+					self._feed_upload(conn, frame)
+					continue
+				if frame.kind != Kind.REQUEST:
+					Log.warning(f"ignoring unexpected frame kind {frame.kind}")
+					continue
+
+				try:
+					data = frame.json()
+				except ValueError:
+					data = None
+
+				upload = None
+				if isinstance(data, dict) and data.get("attachment"):
+					# 添付データの受信を待つ間は同時処理数の枠を使わない (枠は受信完了後に確保する)
+					upload = Upload(IMAGE_MAX_BYTES)
+					if len(conn.uploads) >= MAX_PENDING_UPLOADS:
+						upload.fail("Too many concurrent uploads")
+					else:
+						conn.uploads[frame.stream_id] = upload
+					data["attachment"] = upload
 				else:
-					response = await self.handler.handle(message)
-     
-			except Exception as exc:
-				Log.error(f"error handling message: {exc}")
-				response = Responses.error(f"Error: {exc}")
-			
-			if response is None:
-				Log.warning("handler returned no response")
-				response = Responses.error("No response from handler")
-
-			payload = json.dumps(response).encode("utf-8")
-			writer.write(payload)
-			await writer.drain()
-			Log.debug(f"sent -> response: {response}")
\ No newline at end of file
+					# 同時処理数の上限に達している間は次のフレームを読まない
+					await conn.limit.acquire()
+
+				if isinstance(data, dict) and data.get("stream"):
+					data["stream"] = conn.emitter(frame.stream_id)
+
+				task = asyncio.create_task(self._process(conn, frame.stream_id, data, upload))
+				conn.tasks.add(task)
+				task.add_done_callback(conn.tasks.discard)
+
+		except asyncio.TimeoutError:
+			Log.warning(f"receiver: {conn.address} did not complete the handshake")
+		except (ConnectionError, ValueError) as exc:
+			Log.warning(f"receiver: connection {conn.address} dropped: {exc}")
+		finally:
+			self.connections.discard(conn)
+			for upload in conn.uploads.values():
+				upload.fail("Connection closed during upload")
+			conn.uploads.clear()
+			# 実行中の処理はDiscord側の副作用があるため中断せず完了を待つ
+			if conn.tasks:
+				await asyncio.gather(*conn.tasks, return_exceptions=True)
+			writer.close()
+			Log.info(f"receiver: {conn.address} disconnected")
+
+	def _feed_upload(self, conn: Connection, frame: Frame):
+		upload = conn.uploads.get(frame.stream_id)
+		if upload is None:
+			# 拒否済み・完了済みのアップロードの残りは読み捨てる
+			return
+		upload.feed(frame.payload, frame.flags)
+		if upload.finished:
+			del conn.uploads[frame.stream_id]
+
+	async def _process(self, conn: Connection, stream_id: int, data, upload: Optional[Upload] = None):
+		if upload is not None:
+			await upload.wait()
+			await conn.limit.acquire()
+
+		try:
+			Log.debug(f"received -> message: {data}")
+			if upload is not None and upload.error is not None:
+				response = Responses.error(upload.error)
+			elif not isinstance(data, dict):
+				response = Responses.error("Invalid JSON")
+			elif data.get("action") == "subscribe":
+				# 購読は接続単位の設定なのでここで処理する
+				response = self._subscribe(conn, data)
+			else:
+				response = await self.handler.handle(data)
+
+		except Exception as exc:
+			Log.error(f"error handling message: {exc}")
+			response = Responses.error(f"Error: {exc}")
+
+		finally:
+			conn.limit.release()
+
+		if response is None:
+			Log.warning("handler returned no response")
+			response = Responses.error("No response from handler")
+
+		try:
+			await conn.send(Kind.RESPONSE, response, stream_id)
+			Log.debug(f"sent -> response: {response}")
+		except ConnectionError as exc:
+			Log.warning(f"could not deliver response to {conn.address}: {exc}")
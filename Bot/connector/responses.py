@@ -5,4 +5,13 @@ class Responses:
 
     @staticmethod
     def error(message: str) -> dict:
-        return {"status": "error", "message": message}
\ No newline at end of file
+        return {"status": "error", "message": message}
+
+    @staticmethod
+    def busy(message: str) -> dict:
+        return {"status": "busy", "message": message}
+
+    @staticmethod
+    def unknown(message: str) -> dict:
+        """処理を始めたが、Discordに反映されたか分からないまま終わった。"""
+        return {"status": "unknown", "message": message}
\ No newline at end of file
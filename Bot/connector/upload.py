@@ -0,0 +1,55 @@
+import asyncio
+
+from connector.protocol import Flags
+
+
+class UploadError(Exception):
+    pass
+
+
+class Upload:
+    """Binary attachment streamed in BLOB frames right after its request.
+
+    Chunks are appended as they arrive, up to ``max_bytes``; anything beyond that
+    is discarded and the upload fails once the final frame is seen.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.error: str | None = None
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def feed(self, chunk: memoryview, flags: int):
+        if self.finished:
+            return
+        if self.error is None:
+            if len(self.buffer) + len(chunk) > self.max_bytes:
+                self.fail(f"Attachment is larger than {self.max_bytes} bytes", finish=False)
+            else:
+                self.buffer += chunk
+        if flags & Flags.ABORT:
+            self.fail("Upload aborted by sender")
+        elif flags & Flags.END:
+            self._done.set()
+
+    def fail(self, reason: str, finish: bool = True):
+        if self.error is None:
+            self.error = reason
+        # 失敗した時点でバッファは不要なので解放する
+        self.buffer = bytearray()
+        if finish:
+            self._done.set()
+
+    async def wait(self):
+        await self._done.wait()
+
+    async def read(self) -> bytes:
+        await self.wait()
+        if self.error is not None:
+            raise UploadError(self.error)
+        return bytes(self.buffer)
@@ -0,0 +1,36 @@
+import discord
+from discord.ext import commands
+
+class on_guild_available(commands.Cog):
+	def __init__(self, bot: commands.Bot):
+		self.bot = bot
+
+	async def index_guild(self, guild: discord.Guild):
+		if self.bot.admin_index is None:
+			return
+		if not guild.chunked:
+			await guild.chunk()
+		self.bot.admin_index.build(guild)
+
+	@commands.Cog.listener()
+	async def on_ready(self):
+		# 起動時に受け取ったサーバーにはon_guild_availableが呼ばれない
+		for guild in self.bot.guilds:
+			await self.index_guild(guild)
+
+	@commands.Cog.listener()
+	async def on_guild_available(self, guild: discord.Guild):
+		# 再接続時にも呼ばれるため、その間の取りこぼしも含めて作り直す
+		await self.index_guild(guild)
+
+	@commands.Cog.listener()
+	async def on_guild_join(self, guild: discord.Guild):
+		await self.index_guild(guild)
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild: discord.Guild):
+		if self.bot.admin_index is not None:
+			self.bot.admin_index.drop(guild.id)
+
+async def setup(bot: commands.Bot):
+	await bot.add_cog(on_guild_available(bot))
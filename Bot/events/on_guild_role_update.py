@@ -0,0 +1,32 @@
+import discord
+from discord.ext import commands
+
+class on_guild_role_update(commands.Cog):
+	def __init__(self, bot: commands.Bot):
+		self.bot = bot
+
+	@commands.Cog.listener()
+	async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+		if before.permissions.administrator == after.permissions.administrator:
+			return
+		if self.bot.admin_index is not None:
+			self.bot.admin_index.build(after.guild)
+		# 誰が影響を受けるか分からないため、サーバー単位で無効化させる
+		await self.bot.receiver.publish("roles", {
+			"event": "guild_roles_update",
+			"guild_id": after.guild.id
+		})
+
+	@commands.Cog.listener()
+	async def on_guild_role_delete(self, role: discord.Role):
+		if not role.permissions.administrator:
+			return
+		if self.bot.admin_index is not None:
+			self.bot.admin_index.build(role.guild)
+		await self.bot.receiver.publish("roles", {
+			"event": "guild_roles_update",
+			"guild_id": role.guild.id
+		})
+
+async def setup(bot: commands.Bot):
+	await bot.add_cog(on_guild_role_update(bot))
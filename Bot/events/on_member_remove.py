@@ -0,0 +1,19 @@
+import discord
+from discord.ext import commands
+
+class on_member_remove(commands.Cog):
+	def __init__(self, bot: commands.Bot):
+		self.bot = bot
+
+	@commands.Cog.listener()
+	async def on_member_remove(self, member: discord.Member):
+		if self.bot.admin_index is not None:
+			self.bot.admin_index.remove_member(member.guild.id, member.id)
+		await self.bot.receiver.publish("members", {
+			"event": "member_remove",
+			"guild_id": member.guild.id,
+			"user_id": member.id
+		})
+
+async def setup(bot: commands.Bot):
+	await bot.add_cog(on_member_remove(bot))
@@ -0,0 +1,22 @@
+import discord
+from discord.ext import commands
+
+class on_member_update(commands.Cog):
+	def __init__(self, bot: commands.Bot):
+		self.bot = bot
+
+	@commands.Cog.listener()
+	async def on_member_update(self, before: discord.Member, after: discord.Member):
+		if before.roles == after.roles:
+			return
+		if self.bot.admin_index is not None:
+			self.bot.admin_index.update_member(after)
+		# ロールが変わった場合はAPI側の管理者キャッシュを無効化させる
+		await self.bot.receiver.publish("members", {
+			"event": "member_update",
+			"guild_id": after.guild.id,
+			"user_id": after.id
+		})
+
+async def setup(bot: commands.Bot):
+	await bot.add_cog(on_member_update(bot))
@@ -0,0 +1,32 @@
+import discord
+from discord.ext import commands
+
+class on_scheduled_event(commands.Cog):
+	def __init__(self, bot: commands.Bot):
+		self.bot = bot
+
+	async def publish(self, name: str, event: discord.ScheduledEvent):
+		await self.bot.receiver.publish("scheduled_events", {
+			"event": name,
+			"guild_id": event.guild_id,
+			"event_id": event.id,
+			"name": event.name,
+			"status": event.status.name,
+			"start_time": event.start_time.isoformat() if event.start_time else None,
+			"end_time": event.end_time.isoformat() if event.end_time else None
+		})
+
+	@commands.Cog.listener()
+	async def on_scheduled_event_create(self, event: discord.ScheduledEvent):
+		await self.publish("scheduled_event_create", event)
+
+	@commands.Cog.listener()
+	async def on_scheduled_event_update(self, before: discord.ScheduledEvent, after: discord.ScheduledEvent):
+		await self.publish("scheduled_event_update", after)
+
+	@commands.Cog.listener()
+	async def on_scheduled_event_delete(self, event: discord.ScheduledEvent):
+		await self.publish("scheduled_event_delete", event)
+
+async def setup(bot: commands.Bot):
+	await bot.add_cog(on_scheduled_event(bot))
@@ -5,18 +5,51 @@ import os
 
 from utils.logger import Logger
 from utils.loader import Loader
+from utils.http import HTTPClient
+from utils.image_cache import ImageCache
+from utils.image_processing import ImageProcessor
+from utils.outbound import OutboundScheduler
+from utils.admin_index import AdminIndex
 from connector.receiver import Receiver
+from connector.idempotency import IdempotencyStore
 
 Log = Logger(__name__)
 
-class VRCEvMngrBot(commands.Bot):
+class VRCEvMngrBot(commands.AutoShardedBot):
 	def __init__(self):
-		super().__init__(command_prefix="!", help_command=None, intents=discord.Intents.default())
+		# メンバー一覧を保持して管理者判定をメモリ上で行う (Developer PortalでServer Members Intentの有効化が必要)
+		member_index = os.environ.get("BOT_MEMBER_INDEX", "0").lower() in ("1", "true")
+		intents = discord.Intents.default()
+		intents.members = member_index
+		# 複数のBotで分担する場合は全体のシャード数と、このBotが担当するシャードを指定する (未指定なら自動)
+		shard_count = os.environ.get("BOT_SHARD_COUNT")
+		shard_ids = os.environ.get("BOT_SHARD_IDS")
+		super().__init__(
+			command_prefix="!",
+			help_command=None,
+			intents=intents,
+			shard_count=int(shard_count) if shard_count else None,
+			shard_ids=[int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None
+		)
 		address = os.environ.get("RECEIVER_ADDRESS")
 		port = os.environ.get("RECEIVER_PORT")
-		self.receiver = Receiver(ip=address, port=int(port), bot=self)
+		max_concurrency = int(os.environ.get("RECEIVER_MAX_CONCURRENCY", 32))
+		self.http_client = HTTPClient()
+		self.image_cache = ImageCache(self.http_client)
+		self.image_processor = ImageProcessor()
+		self.outbound = OutboundScheduler()
+		# 再送されたジョブを再起動後も二重に実行しないよう、受け付けたidempotency_keyを記録する
+		self.idempotency = IdempotencyStore()
+		self.admin_index = AdminIndex() if member_index else None
+		self.receiver = Receiver(ip=address, port=int(port), bot=self, max_concurrency=max_concurrency)
 
 	async def setup_hook(self):
+		await self.http_client.start()
+		await self.image_cache.load()
+		await self.idempotency.open()
+		self.image_processor.start()
+		self.outbound.start()
+
 		try:
 			await self.receiver.start()
 		except OSError as exc:
@@ -29,6 +62,10 @@ class VRCEvMngrBot(commands.Bot):
 	async def close(self):
 		if self.receiver is not None:
 			await self.receiver.stop()
+		await self.outbound.stop()
+		await self.idempotency.close()
+		await self.http_client.close()
+		self.image_processor.close()
 		await super().close()
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import time
+from typing import Optional
+
+import discord
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+
+def is_admin(member: discord.Member) -> bool:
+    return any(role.permissions.administrator for role in member.roles)
+
+
+class AdminIndex:
+    """Admin user IDs per guild, kept in memory from the member cache.
+
+    Needs the members intent: a guild is only indexed once it has been chunked, and
+    lookups for any other guild return None so the caller can fall back to the REST API.
+    """
+
+    def __init__(self):
+        self.guilds: dict[int, set[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    def build(self, guild: discord.Guild):
+        if not guild.chunked:
+            Log.warning(f"guild {guild.id} is not chunked; admin index not built")
+            return
+        started_at = time.perf_counter()
+        self.guilds[guild.id] = {member.id for member in guild.members if is_admin(member)}
+        self.rebuilds += 1
+        Log.info(
+            f"indexed {len(self.guilds[guild.id])} admins of {guild.member_count} members in guild {guild.id} "
+            f"({(time.perf_counter() - started_at) * 1000:.1f}ms)"
+        )
+
+    def drop(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+    def update_member(self, member: discord.Member):
+        admins = self.guilds.get(member.guild.id)
+        if admins is None:
+            return
+        if is_admin(member):
+            admins.add(member.id)
+        else:
+            admins.discard(member.id)
+
+    def remove_member(self, guild_id: int, user_id: int):
+        admins = self.guilds.get(guild_id)
+        if admins is not None:
+            admins.discard(user_id)
+
+    def lookup(self, guild_id: int, user_id: int) -> Optional[bool]:
+        """管理者ならTrue、そうでなければFalse。インデックスがないサーバーの場合はNone。"""
+        admins = self.guilds.get(guild_id)
+        if admins is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return user_id in admins
+
+    def stats(self) -> dict:
+        return {
+            "guilds": len(self.guilds),
+            "admins": sum(len(admins) for admins in self.guilds.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rebuilds": self.rebuilds,
+        }
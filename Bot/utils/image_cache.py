@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import os
+import secrets
+import time
+import weakref
+from collections import OrderedDict
+
+import aiohttp
+import aiofiles
+import aiofiles.os
+
+from utils.http import HTTPClient
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", "/Cache/images")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+IMAGE_CACHE_FRESH_SECONDS = int(os.environ.get("IMAGE_CACHE_FRESH_SECONDS", 3600))
+IMAGE_MAX_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+ALLOWED_CONTENT_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp")
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+class ImageCache:
+    """On-disk cache of downloaded images.
+
+    Files are stored by the SHA-256 of their content, and an index maps each URL to
+    its content hash plus the validators (ETag / Last-Modified) used to revalidate it.
+    Entries are evicted least-recently-used first once the total size exceeds the limit.
+    """
+
+    def __init__(self, http_client: HTTPClient, directory: str = IMAGE_CACHE_DIR,
+                 max_bytes: int = IMAGE_CACHE_MAX_BYTES, max_image_bytes: int = IMAGE_MAX_BYTES):
+        self.http_client = http_client
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        # url -> {"hash", "size", "etag", "last_modified", "fetched_at"} (LRU順)
+        self.index: OrderedDict[str, dict] = OrderedDict()
+        self._locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    async def load(self):
+        await aiofiles.os.makedirs(self.directory, exist_ok=True)
+        try:
+            async with aiofiles.open(self.index_path, "r", encoding="utf-8") as f:
+                self.index = OrderedDict(json.loads(await f.read()))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            Log.warning(f"discarding unreadable image cache index: {e}")
+            self.index = OrderedDict()
+        Log.info(f"image cache loaded: {len(self.index)} entries, {self.total_bytes()} bytes")
+
+    async def fetch(self, url: str) -> bytes:
+        """Returns the image at ``url``, downloading it only when the cached copy is missing or stale.
+
+        Raises:
+            ImageFetchError: the image could not be fetched or is not an acceptable image
+        """
+        lock = self._locks.get(url)
+        if lock is None:
+            lock = self._locks[url] = asyncio.Lock()
+
+        # 同じURLへの同時リクエストはまとめて1回だけダウンロードする
+        async with lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.index.move_to_end(url)
+                if time.time() - entry["fetched_at"] < IMAGE_CACHE_FRESH_SECONDS:
+                    data = await self._read_blob(entry["hash"])
+                    if data is not None:
+                        self.hits += 1
+                        return data
+            return await self._download(url, entry)
+
+    async def _download(self, url: str, entry: dict | None) -> bytes:
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            async with self.http_client.session.get(url, headers=headers) as resp:
+                not_modified = resp.status == 304 and entry is not None
+                if not not_modified:
+                    self._check_response(resp)
+                    buffer = bytearray()
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        buffer += chunk
+                        if len(buffer) > self.max_image_bytes:
+                            raise ImageFetchError(f"Image is larger than {self.max_image_bytes} bytes")
+
+                    etag = resp.headers.get("ETag")
+                    last_modified = resp.headers.get("Last-Modified")
+
+        except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+            raise ImageFetchError(f"Failed to fetch image from URI: {e}") from e
+
+        if not_modified:
+            data = await self._read_blob(entry["hash"])
+            if data is None:
+                # キャッシュファイルが消えていた場合は条件なしで取り直す
+                return await self._download(url, None)
+            self.revalidated += 1
+            entry["fetched_at"] = time.time()
+            await self._save_index()
+            return data
+
+        data = bytes(buffer)
+        self.misses += 1
+        digest = hashlib.sha256(data).hexdigest()
+        await self._write_blob(digest, data)
+        self.index[url] = {
+            "hash": digest,
+            "size": len(data),
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        self.index.move_to_end(url)
+        await self._evict()
+        await self._save_index()
+        return data
+
+    def _check_response(self, resp: aiohttp.ClientResponse):
+        if resp.status != 200:
+            raise ImageFetchError(f"Failed to fetch image from URI (HTTP {resp.status})")
+        if resp.content_type not in ALLOWED_CONTENT_TYPES:
+            raise ImageFetchError(f"Unsupported image content type: {resp.content_type}")
+        if resp.content_length is not None and resp.content_length > self.max_image_bytes:
+            raise ImageFetchError(f"Image is larger than {self.max_image_bytes} bytes")
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    async def _read_blob(self, digest: str) -> bytes | None:
+        try:
+            async with aiofiles.open(self._blob_path(digest), "rb") as f:
+                return await f.read()
+        except FileNotFoundError:
+            return None
+
+    async def _write_blob(self, digest: str, data: bytes):
+        path = self._blob_path(digest)
+        if await aiofiles.os.path.exists(path):
+            return
+        # 同じ内容を同時に書き込む場合もあるため、一時ファイルは書き込みごとに分ける
+        tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(data)
+            await aiofiles.os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                await aiofiles.os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def total_bytes(self) -> int:
+        return sum({entry["hash"]: entry["size"] for entry in self.index.values()}.values())
+
+    async def _evict(self):
+        sizes = {entry["hash"]: entry["size"] for entry in self.index.values()}
+        total = sum(sizes.values())
+        while total > self.max_bytes and len(self.index) > 1:
+            url, entry = self.index.popitem(last=False)
+            # 同じ内容を参照している他のURLが残っていればファイルは消さない
+            if any(other["hash"] == entry["hash"] for other in self.index.values()):
+                continue
+            total -= entry["size"]
+            try:
+                await aiofiles.os.remove(self._blob_path(entry["hash"]))
+            except FileNotFoundError:
+                pass
+            Log.debug(f"evicted cached image for {url}")
+
+    async def _save_index(self):
+        # 異なるURLの取得が同時に保存することがあるため、一時ファイルは保存ごとに分ける
+        tmp_path = f"{self.index_path}.{secrets.token_hex(4)}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, "w", encoding="utf-8") as f:
+                await f.write(json.dumps(self.index))
+            await aiofiles.os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            Log.warning(f"failed to save image cache index: {e}")
+            try:
+                await aiofiles.os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.index),
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+        }
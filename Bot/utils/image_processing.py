@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import io
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+# Discordのイベントカバー画像は 800x320 (2.5:1)。高解像度ディスプレイ向けに2倍で保存する
+IMAGE_COVER_SIZE = (1600, 640)
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", 85))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+IMAGE_MEMO_ENTRIES = int(os.environ.get("IMAGE_MEMO_ENTRIES", 32))
+
+
+class ImageProcessingError(Exception):
+    pass
+
+
+def preprocess(data: bytes, size: tuple[int, int], quality: int) -> bytes:
+    """Crops and downsizes an image to the cover aspect ratio and re-encodes it without metadata.
+
+    Runs in a worker process, so it must stay a picklable top-level function.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        # アニメーションGIFは変換するとフレームが失われるためそのまま使う
+        if getattr(source, "is_animated", False):
+            return data
+
+        image = ImageOps.exif_transpose(source)
+        width, height = image.size
+        ratio = size[0] / size[1]
+        if width / height > ratio:
+            crop_width = round(height * ratio)
+            left = (width - crop_width) // 2
+            image = image.crop((left, 0, left + crop_width, height))
+        else:
+            crop_height = round(width / ratio)
+            top = (height - crop_height) // 2
+            image = image.crop((0, top, width, top + crop_height))
+
+        # 拡大はしない
+        if image.width > size[0]:
+            image = image.resize(size, Image.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.convert("RGBA").save(output, "PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+class ImageProcessor:
+    """Runs ``preprocess`` in a process pool and memoizes results by the source's SHA-256."""
+
+    def __init__(self, workers: int = IMAGE_WORKERS, memo_entries: int = IMAGE_MEMO_ENTRIES):
+        self.workers = workers
+        self.memo_entries = memo_entries
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._memo: OrderedDict[str, bytes] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.process_time = 0.0
+
+    def start(self):
+        if self._executor is None:
+            # Botはスレッドを持つためforkではなくspawnでワーカーを作る
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def process(self, data: bytes) -> bytes:
+        digest = hashlib.sha256(data).hexdigest()
+        result = self._memo.get(digest)
+        if result is not None:
+            self._memo.move_to_end(digest)
+            self.hits += 1
+            return result
+
+        # 同じ画像の処理が進行中ならその結果を待つ。処理は独立したタスクで行うため、
+        # 最初の呼び出し元がキャンセルされても他の呼び出しは結果を受け取れる
+        task = self._inflight.get(digest)
+        if task is not None:
+            self.hits += 1
+        else:
+            task = asyncio.create_task(self._run(data))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda done: self._settle(digest, done))
+        return await asyncio.shield(task)
+
+    def _settle(self, digest: str, task: asyncio.Task):
+        if self._inflight.get(digest) is task:
+            del self._inflight[digest]
+        if task.cancelled():
+            return
+        # 待っている呼び出しがない場合に未取得の例外として警告されないようにする
+        if task.exception() is not None:
+            return
+        self.misses += 1
+        self._memo[digest] = task.result()
+        while len(self._memo) > self.memo_entries:
+            self._memo.popitem(last=False)
+
+    async def _run(self, data: bytes) -> bytes:
+        self.start()
+        started_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self._executor, preprocess, data, IMAGE_COVER_SIZE, IMAGE_JPEG_QUALITY
+            )
+        except BrokenProcessPool as e:
+            Log.error(f"image worker pool crashed, restarting: {e}")
+            self.close()
+            raise ImageProcessingError("Image processing failed") from e
+        except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+            raise ImageProcessingError("Unsupported or corrupt image") from e
+        except (OSError, ValueError) as e:
+            raise ImageProcessingError(f"Failed to process image: {e}") from e
+
+        elapsed = time.perf_counter() - started_at
+        self.process_time += elapsed
+        self.bytes_in += len(data)
+        self.bytes_out += len(result)
+        Log.debug(f"preprocessed image {len(data)} -> {len(result)} bytes in {elapsed:.3f}s")
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memo_entries": len(self._memo),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "process_avg_ms": round(self.process_time / self.misses * 1000, 3) if self.misses else 0.0,
+        }
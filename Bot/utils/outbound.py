@@ -0,0 +1,296 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, Optional
+
+import discord
+
+from utils.logger import Logger
+
+Log = Logger(__name__)
+
+# Discordのグローバル上限(50/s)より少し低く抑え、discord.py側で待たされないようにする
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 45))
+# グローバル枠のうち認証(メンバー取得)用に残しておく数。告知が集中しても認証は待たない
+OUTBOUND_AUTH_RESERVE = float(os.environ.get("OUTBOUND_AUTH_RESERVE", 10))
+
+
+class Limit(NamedTuple):
+    requests: float
+    per: float
+
+
+@dataclass(frozen=True)
+class RouteLimits:
+    route: Optional[Limit] = None
+    guild: Optional[Limit] = None
+    channel: Optional[Limit] = None
+    auth: bool = False          # Trueの場合はグローバル枠の予約分も使える
+    max_inflight: int = 4
+
+
+ROUTES = {
+    "send_message": RouteLimits(channel=Limit(5, 5), max_inflight=4),
+    "create_event": RouteLimits(guild=Limit(5, 5), max_inflight=4),
+    "fetch_member": RouteLimits(guild=Limit(20, 1), auth=True, max_inflight=16),
+}
+
+
+class TokenBucket:
+    def __init__(self, limit: Limit):
+        self.capacity = limit.requests
+        self.rate = limit.requests / limit.per
+        self.tokens = limit.requests
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float, reserve: float = 0.0) -> float:
+        """トークンを1つ取れるまでの秒数。``reserve`` 分は残しておく。"""
+        self._refill(now)
+        needed = 1 + reserve - self.tokens
+        return 0.0 if needed <= 0 else needed / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+@dataclass
+class RouteStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    coalesced: int = 0
+    queue_total: float = 0.0
+    queue_max: float = 0.0
+    discord_total: float = 0.0
+    discord_max: float = 0.0
+
+    def snapshot(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "coalesced": self.coalesced,
+            "queue_avg_ms": round(self.queue_total / finished * 1000, 3) if finished else 0.0,
+            "queue_max_ms": round(self.queue_max * 1000, 3),
+            "discord_avg_ms": round(self.discord_total / finished * 1000, 3) if finished else 0.0,
+            "discord_max_ms": round(self.discord_max * 1000, 3),
+        }
+
+
+@dataclass
+class Call:
+    factory: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    guild_id: Optional[int]
+    channel_id: Optional[int]
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Route:
+    """Queue for one kind of Discord call, served round-robin across callers."""
+
+    def __init__(self, name: str, limits: RouteLimits):
+        self.name = name
+        self.limits = limits
+        self.bucket = TokenBucket(limits.route) if limits.route else None
+        self.guild_buckets: dict[int, TokenBucket] = {}
+        self.channel_buckets: dict[int, TokenBucket] = {}
+        # caller -> 呼び出し元ごとのFIFO (順番に1件ずつ取り出す)
+        self.callers: OrderedDict[Hashable, deque[Call]] = OrderedDict()
+        self.inflight = 0
+        self.stats = RouteStats()
+
+    def queued(self) -> int:
+        return sum(len(calls) for calls in self.callers.values())
+
+    def buckets(self, call: Call) -> list[TokenBucket]:
+        buckets = [self.bucket] if self.bucket else []
+        if self.limits.guild and call.guild_id is not None:
+            bucket = self.guild_buckets.get(call.guild_id)
+            if bucket is None:
+                bucket = self.guild_buckets[call.guild_id] = TokenBucket(self.limits.guild)
+            buckets.append(bucket)
+        if self.limits.channel and call.channel_id is not None:
+            bucket = self.channel_buckets.get(call.channel_id)
+            if bucket is None:
+                bucket = self.channel_buckets[call.channel_id] = TokenBucket(self.limits.channel)
+            buckets.append(bucket)
+        return buckets
+
+
+class OutboundScheduler:
+    """Paces calls to Discord with token buckets per route, guild and channel.
+
+    Callers are served round-robin within a route so one flood cannot starve the others,
+    and every route has its own queue, so member lookups never wait behind announcements.
+    """
+
+    def __init__(self, routes: dict[str, RouteLimits] = ROUTES, global_rate: float = OUTBOUND_GLOBAL_RATE,
+                 auth_reserve: float = OUTBOUND_AUTH_RESERVE):
+        self.routes = {name: Route(name, limits) for name, limits in routes.items()}
+        self.global_bucket = TokenBucket(Limit(global_rate, 1))
+        self.auth_reserve = auth_reserve
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set[asyncio.Task] = set()
+        self._member_fetches: dict[tuple[int, int], asyncio.Task] = {}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        for route in self.routes.values():
+            for calls in route.callers.values():
+                for call in calls:
+                    call.future.cancel()
+            route.callers.clear()
+        for task in list(self._running):
+            task.cancel()
+
+    async def submit(self, route: str, factory: Callable[[], Awaitable[Any]], *, caller: Hashable = None,
+                     guild_id: Optional[int] = None, channel_id: Optional[int] = None):
+        """``factory()`` の呼び出しを順番待ちに入れ、実行結果を返す。"""
+        queue = self.routes[route]
+        call = Call(factory, asyncio.get_running_loop().create_future(), guild_id, channel_id)
+        queue.callers.setdefault(caller, deque()).append(call)
+        queue.stats.submitted += 1
+        self._wakeup.set()
+        return await call.future
+
+    async def fetch_member(self, guild: discord.Guild, user_id: int, caller: Hashable = None) -> discord.Member:
+        """同じメンバーの取得が進行中ならその結果を共有する。
+
+        取得は独立したタスクで行うため、最初の呼び出し元がキャンセルされても他の呼び出しは結果を受け取れる。
+        """
+        key = (guild.id, user_id)
+        task = self._member_fetches.get(key)
+        if task is not None:
+            self.routes["fetch_member"].stats.coalesced += 1
+        else:
+            task = asyncio.create_task(self.submit("fetch_member", lambda: guild.fetch_member(user_id),
+                                                   caller=caller, guild_id=guild.id))
+            self._member_fetches[key] = task
+            task.add_done_callback(lambda done: self._forget_member_fetch(key, done))
+        return await asyncio.shield(task)
+
+    def _forget_member_fetch(self, key: tuple[int, int], task: asyncio.Task):
+        if self._member_fetches.get(key) is task:
+            del self._member_fetches[key]
+        # 待っている呼び出しがない場合に未取得の例外として警告されないようにする
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._schedule()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _schedule(self) -> Optional[float]:
+        """実行できる呼び出しを全て開始し、次に確認するまでの秒数を返す(待つものがなければNone)。"""
+        now = time.monotonic()
+        delay: Optional[float] = None
+        for route in self.routes.values():
+            while route.callers and route.inflight < route.limits.max_inflight:
+                wait = self._start_next(route, now)
+                if wait is None:
+                    continue
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                break
+        return delay
+
+    def _start_next(self, route: Route, now: float) -> Optional[float]:
+        """呼び出し元を順番に見て、最初に実行できるものを開始する。
+
+        Returns:
+            開始した(または取り消し済みを捨てた)場合はNone、どれも実行できない場合は待つ秒数
+        """
+        reserve = 0.0 if route.limits.auth else self.auth_reserve
+        shortest: Optional[float] = None
+        for caller in list(route.callers):
+            calls = route.callers[caller]
+            call = calls[0]
+            if call.future.done():
+                # 呼び出し元がタイムアウトなどで待つのをやめた
+                calls.popleft()
+                route.stats.cancelled += 1
+                if not calls:
+                    del route.callers[caller]
+                return None
+
+            buckets = [self.global_bucket, *route.buckets(call)]
+            wait = max(
+                self.global_bucket.wait_time(now, reserve),
+                *(bucket.wait_time(now) for bucket in buckets[1:]),
+            )
+            if wait > 0:
+                shortest = wait if shortest is None else min(shortest, wait)
+                continue
+
+            for bucket in buckets:
+                bucket.take()
+            calls.popleft()
+            # 実行した呼び出し元は列の最後に回す
+            del route.callers[caller]
+            if calls:
+                route.callers[caller] = calls
+            # 同じ_scheduleの中で上限を超えて開始しないよう、タスクを作った時点で数える
+            route.inflight += 1
+            task = asyncio.create_task(self._execute(route, call, now))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            return None
+        return shortest
+
+    async def _execute(self, route: Route, call: Call, started_at: float):
+        stats = route.stats
+        queued = started_at - call.enqueued_at
+        stats.queue_total += queued
+        stats.queue_max = max(stats.queue_max, queued)
+
+        try:
+            result = await call.factory()
+        except asyncio.CancelledError:
+            call.future.cancel()
+            raise
+        except Exception as e:
+            stats.failed += 1
+            if not call.future.done():
+                call.future.set_exception(e)
+        else:
+            stats.completed += 1
+            if not call.future.done():
+                call.future.set_result(result)
+        finally:
+            elapsed = time.monotonic() - started_at
+            stats.discord_total += elapsed
+            stats.discord_max = max(stats.discord_max, elapsed)
+            route.inflight -= 1
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            name: {"queued": route.queued(), "inflight": route.inflight, **route.stats.snapshot()}
+            for name, route in self.routes.items()
+        }